@@ -1,7 +1,15 @@
-import os, time, configparser, subprocess, getopt, sys, multiprocessing, colorama
-from backutil_subfuncs import log, manage_previous_db, manage_tracker_db, generate_hashes, copy_files, get_prev_hashes, print_header
+import os, time, configparser, subprocess, getopt, sys, multiprocessing, shutil, cProfile, colorama, concurrent.futures
+from backutil_subfuncs import hash_algorithms, log, configure_logging, get_log_queue, init_worker, log_state, configure_throttle, start_throttle_schedule, stop_throttle_schedule, throttle_state, get_low_priority_command, manage_previous_db, manage_tracker_db, generate_hashes, copy_files, get_prev_hashes, print_header, get_cached_hashes, update_hash_cache, copy_files_native, hash_and_copy_files, discard_staged_file, write_archive_list, load_session, save_session, set_journal_state, get_journal_files, checkpoint, get_staging_path, is_compressed_file, schedule_volumes, get_archive_member, write_catalog, expire_catalog, load_temp_files, get_file_size, schedule_batches, read_backup_list, enumerate_files, timed_batch, sum_file_sizes, record_phase, write_metrics
+from backutil_chunkstore import manage_chunk_db, store_chunks, prune_chunk_store
+from backutil_watch import get_dirty_files, load_dirty_files, finish_dirty_set
 
 version = "0.70"
+copy_engines = ("robocopy", "native")
+archive_modes = ("staged", "stream", "chunks")
+archive_profiles = {"store": "-mx=0", "fast": "-m0=lzma2 -mx=1", "normal": "-m0=lzma2 -mx=5", "max": "-m0=lzma2 -mx=9"}
+
+# Settings each profile of a multi-profile run takes from the LOCAL section
+profile_settings = ("hash_cache", "verify_hashes", "copy_engine", "archive_mode", "parallel_walk", "hash_algorithm", "hash_buffer", "checkpoint", "resume", "archive_volumes", "archive_profile", "store_compressed", "watch", "full_scan_interval", "metrics_file")
 
 class Config:
     def __init__(self, computer_name, backup_list_file, staging_folder, archive_password, server_directory, backups_rotated, backups_retained, too_many_backups, incremental, max_threads):
@@ -24,13 +32,63 @@ class Config:
         self.tracker_db_cursor = ""
         self.files_to_back_up = []
         self.max_threads = max_threads
+        self.hash_cache = "True"
+        self.cache_db_name = ""
+        self.cache_db_conn = ""
+        self.cache_db_cursor = ""
+        self.verify_hashes = "False"
+        self.file_stats = {}
+        self.copy_engine = "robocopy"
+        self.pipeline = "False"
+        self.archive_mode = "staged"
+        self.chunk_repository = ""
+        self.chunk_db_name = ""
+        self.chunk_db_conn = ""
+        self.chunk_db_cursor = ""
+        self.parallel_walk = "False"
+        self.hash_algorithm = "sha256"
+        self.hash_buffer = 64
+        self.log_level = "Attempt"
+        self.log_format = "csv"
+        self.metrics = []
+        self.metrics_file = ""
+        self.metrics_prom_file = ""
+        self.profile_file = ""
+        self.run_start = time.perf_counter()
+        self.run_started = int(time.time())
+        self.checkpoint = "True"
+        self.resume = "False"
+        self.session_state = ""
+        self.last_checkpoint = 0
+        self.archive_volumes = 1
+        self.archive_profile = "normal"
+        self.store_compressed = "False"
+        self.throttle_read = 0
+        self.throttle_write = 0
+        self.throttle_iops = 0
+        self.throttle_nice = "False"
+        self.throttle_schedule = ""
+        self.archive_names = {}
+        self.watch = "False"
+        self.full_scan_interval = 24
+        self.partial_scan = "False"
+        self.scan_time = 0
+        self.dirty_files = []
+        self.dirty_rows = []
+        self.dirty_db_name = ""
+        self.dirty_db_conn = ""
+        self.dirty_db_cursor = ""
+        self.worker_pool = ""
+        self.walk_cache = ""
+        self.max_profiles = 1
+        self.profiles = ""
 
 
 # Parse command line options
 def cl_options(config):
     log("Reading command line arguments...", "Attempt", version)
-    options_s = "hn:l:ir:t:"
-    options_l = ["name=", "list=", "incremental", "rotate=", "help", "threads="]
+    options_s = "hn:l:ir:t:vc:pa:H:qP:RV:z:T:Fm:"
+    options_l = ["name=", "list=", "incremental", "rotate=", "help", "threads=", "verify", "copy-engine=", "pipeline", "archive-mode=", "hash=", "quiet", "profile=", "resume", "volumes=", "compression=", "throttle=", "full-scan", "multi="]
     full_cmd_arguments = sys.argv
     argument_list = full_cmd_arguments[1:]
     arguments, values = getopt.getopt(argument_list, options_s, options_l)
@@ -52,90 +110,513 @@ def cl_options(config):
             config.backups_retained = int(current_value)
             log("Backup rotation set via command line arguments.", "Success", version)
         if current_argument in ("-t", "--threads"):
-            config.max_threads = current_value
+            config.max_threads = int(current_value)
             log("Maximum threads set via command line arguments.", "Success", version)
+        if current_argument in ("-v", "--verify"):
+            config.verify_hashes = "True"
+            log("Full hash verification set via command line arguments.", "Success", version)
+        if current_argument in ("-c", "--copy-engine"):
+            if current_value not in copy_engines:
+                raise ValueError("Unknown copy engine: " + current_value)
+            config.copy_engine = current_value
+            log("Copy engine set via command line arguments.", "Success", version)
+        if current_argument in ("-p", "--pipeline"):
+            config.pipeline = "True"
+            log("Hash-and-copy pipeline set via command line arguments.", "Success", version)
+        if current_argument in ("-a", "--archive-mode"):
+            if current_value not in archive_modes:
+                raise ValueError("Unknown archive mode: " + current_value)
+            config.archive_mode = current_value
+            log("Archive mode set via command line arguments.", "Success", version)
+        if current_argument in ("-H", "--hash"):
+            if current_value not in hash_algorithms:
+                raise ValueError("Unknown or unavailable hash algorithm: " + current_value)
+            config.hash_algorithm = current_value
+            log("Hash algorithm set via command line arguments.", "Success", version)
+        if current_argument in ("-q", "--quiet"):
+            config.log_level = "Warning"
+            configure_logging(config.log_level, config.log_format)
+        if current_argument in ("-P", "--profile"):
+            config.profile_file = current_value
+            log("Profiling set via command line arguments.", "Success", version)
+        if current_argument in ("-R", "--resume"):
+            config.resume = "True"
+            log("Resume set via command line arguments.", "Success", version)
+        if current_argument in ("-V", "--volumes"):
+            config.archive_volumes = int(current_value)
+            log("Archive volumes set via command line arguments.", "Success", version)
+        if current_argument in ("-z", "--compression"):
+            if current_value not in archive_profiles:
+                raise ValueError("Unknown compression profile: " + current_value)
+            config.archive_profile = current_value
+            log("Compression profile set via command line arguments.", "Success", version)
+        if current_argument in ("-T", "--throttle"):
+            config.throttle_read = float(current_value)
+            config.throttle_write = float(current_value)
+            log("Throttle set via command line arguments.", "Success", version)
+        if current_argument in ("-F", "--full-scan"):
+            config.full_scan_interval = 0
+            log("Full scan set via command line arguments.", "Success", version)
+        if current_argument in ("-m", "--multi"):
+            config.profiles = current_value
+            log("Multi-profile backup set via command line arguments.", "Success", version)
     log("Command line arguments read successfully.", "Success", version)
     
 
-# Checks number of backups and sets number to delete after backup
-def check_backups(config):
-    log("Checking number of previous backups...", "Attempt", version)
-    
-    # Get list of existing backup files
-    backup_files = []
+# Get existing backup files, grouped by backup - volumes of the same backup share its name
+def get_backup_archives(config):
+    backup_archives = {}
     backup_directory = config.server_directory + config.computer_name
     for root, directories, filenames in os.walk(backup_directory):
         for filename in filenames: 
             if ".7z" in filename:
-                backup_files.append(os.path.join(root,filename))
+                backup_archives.setdefault(filename.split(".")[0], []).append(os.path.join(root,filename))
+    return backup_archives
+
+
+# Checks number of backups and sets number to delete after backup
+def check_backups(config):
+    log("Checking number of previous backups...", "Attempt", version)
+    start = time.perf_counter()
+    
+    # Get list of existing backups
+    backup_archives = get_backup_archives(config)
                 
     # If more than enough, set flag
-    if len(backup_files) >= (config.backups_retained - 1):
-        config.too_many_backups = len(backup_files) - (config.backups_retained - 1)
+    if len(backup_archives) >= (config.backups_retained - 1):
+        config.too_many_backups = len(backup_archives) - (config.backups_retained - 1)
     
+    record_phase(config, "check_backups", start, len(backup_archives), 0)
     log("Previous backups checked successfully.", "Success", version)
 
 
+# Start a bounded worker pool - each worker picks up logging, throttling and priority settings
+def start_worker_pool(max_workers):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(get_log_queue(), log_state.level, throttle_state.buckets, throttle_state.nice,))
+
+
+# Run batches through a bounded worker pool - idle workers take the next batch from a shared queue
+def run_worker_pool(config, phase, target, batches, target_args, consume_batch, failure_msg):
+    start = time.perf_counter()
+    workers = {}
+    file_count = 0
+    total_bytes = 0
+
+    # Profiles in a multi-profile run share one pool, otherwise the pool only lasts for this phase
+    executor = config.worker_pool
+    if executor == "":
+        executor = start_worker_pool(config.max_threads)
+    try:
+        futures = {}
+        x = 1
+        for batch in batches:
+            futures[executor.submit(timed_batch, target, x, batch, *target_args, version)] = batch
+            x += 1
+        
+        # Hand each batch's output over as soon as it arrives, rather than waiting for every worker
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                pid, seconds, batch_output = future.result()
+            except:
+                log(failure_msg, "Failure", version)
+                for pending_future in futures:
+                    pending_future.cancel()
+                sys.exit()
+            consume_batch(batch_output)
+            # Drop the finished future so its batch and output can be freed before the run ends
+            batch = futures.pop(future)
+            batch_bytes = sum_file_sizes(batch, config.file_stats)
+            worker = workers.setdefault(pid, {"pid": pid, "batches": 0, "seconds": 0, "bytes": 0})
+            worker["batches"] += 1
+            worker["seconds"] += seconds
+            worker["bytes"] += batch_bytes
+            file_count += len(batch)
+            total_bytes += batch_bytes
+    finally:
+        if executor is not config.worker_pool:
+            executor.shutdown(wait=True)
+    record_phase(config, phase, start, file_count, total_bytes, workers)
+
+
+# Bulk insert a batch of hashes into the tracker DB, recording progress in the checkpoint journal
+def insert_tracker_batch(config, batch_output, hashed, state="hashed"):
+    query_data = ((key, value, hashed) for key, value in batch_output.items())
+    config.tracker_db_cursor.executemany("INSERT INTO backutil_tracker (file, hash, hashed) VALUES (?, ?, ?);", query_data)
+    set_journal_state(config, batch_output.keys(), state)
+    checkpoint(config)
+
+
+# Copy files to the session folder, then archive and password protect it as .7z
+def staged_archive(config, files_to_copy, staged_dict):
+    log("Copying files to session folder...", "Attempt", version)
+        
+    # Batch files to be backed up by size and copy them in the worker pool
+    if config.copy_engine == "native":
+        copy_target = copy_files_native
+    else:
+        copy_target = copy_files
+    sizes = [get_file_size(backup_file[0], config.file_stats) for backup_file in files_to_copy]
+    batches = schedule_batches(files_to_copy, sizes, config.max_threads)
+
+    # Recombine worker output (successfully copied files) ready to add to previous DB
+    combined_dict = staged_dict
+    files_by_hash = {}
+    for backup_file in files_to_copy:
+        files_by_hash.setdefault(backup_file[1], []).append(backup_file[0])
+    def consume_batch(batch_output):
+        combined_dict.update(batch_output)
+        for key in batch_output.keys():
+            set_journal_state(config, files_by_hash[key], "staged")
+        checkpoint(config)
+    run_worker_pool(config, "copy", copy_target, batches, (config.staging_folder, config.backup_time,), consume_batch, "File copy thread failed.")
+                       
+    log("Files copied to session folder successfully.", "Success", version)
+
+    # Archive and password protect .7z - a single volume archives the whole session folder
+    log("Creating .7z archive...", "Attempt", version)
+    start = time.perf_counter()
+    volumes = plan_volumes(config, [backup_file for backup_file in config.files_to_back_up if backup_file[1] in combined_dict])
+    if len(volumes) <= 1:
+        for backup_file in volumes[0][1]:
+            config.archive_names[backup_file[0]] = config.backup_time + ".7z"
+        command = "7z a -t7z -mhc=on -mhe=on " + volumes[0][0] + " -mmt=" + str(config.max_threads) + " \"" + config.server_directory + config.computer_name + "\\" + config.backup_time + ".7z\" " + config.staging_folder + config.backup_time +" -p" + config.archive_password
+        command, creationflags = get_low_priority_command(command)
+        outputs = [subprocess.call(command, shell=True, stdout=config.FNULL, stderr=subprocess.STDOUT, creationflags=creationflags)]
+    else:
+        outputs = write_volumes(config, volumes, "staged")
+    record_phase(config, "archive", start, len(combined_dict), sum_file_sizes(files_to_copy, config.file_stats))
+    combined_dict = get_archived_hashes(config, volumes, outputs)
+    log_archive_result(outputs)
+    return combined_dict
+
+
+# Archive and password protect .7z by reading source files directly, without staging copies
+def stream_archive(config, files_to_back_up):
+    # 7-Zip reads each listed file once, so peak extra disk is the archive itself
+    log("Creating .7z archive from source files...", "Attempt", version)
+    start = time.perf_counter()
+    volumes = split_volumes_by_drive(plan_volumes(config, files_to_back_up))
+    outputs = write_volumes(config, volumes, "stream")
+    record_phase(config, "archive", start, len(files_to_back_up), sum_file_sizes(files_to_back_up, config.file_stats))
+    combined_dict = get_archived_hashes(config, volumes, outputs)
+    log_archive_result(outputs)
+    return combined_dict
+
+
+# Get the hashes of files that are in the archive volumes - 7-Zip returns 1 when it skips files it cannot open, so those volumes are listed
+def get_archived_hashes(config, volumes, outputs):
+    combined_dict = {}
+    for (profile, volume), output in zip(volumes, outputs):
+        if len(volume) == 0:
+            continue
+        volume_name = config.archive_names[volume[0][0]]
+        archived = []
+        if output == 0:
+            archived = volume
+        elif output == 1:
+            members = list_archive_members(config, volume_name)
+            if members is not None:
+                archived = [backup_file for backup_file in volume if get_archive_member(backup_file[0], config.archive_mode, config.backup_time) in members]
+
+        # Missing files are not recorded as backed up, so the next incremental backup tries them again
+        archived_files = set(backup_file[0] for backup_file in archived)
+        for backup_file in volume:
+            if backup_file[0] in archived_files:
+                combined_dict[backup_file[1]] = "Y"
+            else:
+                config.archive_names.pop(backup_file[0], None)
+                log("Not in " + volume_name + ": " + backup_file[0], "Warning", version)
+    return combined_dict
+
+
+# List the members of an archive volume - returns None if it cannot be listed
+def list_archive_members(config, volume_name):
+    command = "7z l -slt -ba -sccUTF-8 \"" + config.server_directory + config.computer_name + "\\" + volume_name + "\" -p" + config.archive_password
+    command, creationflags = get_low_priority_command(command)
+    try:
+        result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, creationflags=creationflags)
+    except:
+        return None
+    if result.returncode != 0:
+        return None
+    lines = result.stdout.decode("utf-8", errors="replace").splitlines()
+    return set(line[len("Path = "):].strip().replace("\\", "/") for line in lines if line.startswith("Path = "))
+
+
+# Log the overall result of writing the archive volumes
+def log_archive_result(outputs):
+    if 1 in outputs and all(output in (0, 1) for output in outputs):
+        log("7z archive created with warnings.", "Warning", version)
+    elif all(output in (0, 1) for output in outputs):
+        log("7z archive created.", "Success", version)
+    else:
+        log("Error creating 7z archive.", "Failure", version)
+
+
+# Split files into archive volumes using the compression profile - already compressed files can go in their own stored volumes
+def plan_volumes(config, files_to_back_up):
+    compress_files = []
+    compress_sizes = []
+    store_files = []
+    store_sizes = []
+    for backup_file in files_to_back_up:
+        size = get_file_size(backup_file[0], config.file_stats)
+        if config.store_compressed == "True" and config.archive_profile != "store" and is_compressed_file(backup_file[0], size):
+            store_files.append(backup_file)
+            store_sizes.append(size)
+        else:
+            compress_files.append(backup_file)
+            compress_sizes.append(size)
+
+    # Volumes are shared between the two kinds of file by size, with at least one each where needed
+    store_count = 0
+    if store_files:
+        total_size = max(sum(compress_sizes) + sum(store_sizes), 1)
+        store_count = max(1, round(config.archive_volumes * sum(store_sizes) / total_size))
+    compress_count = max(1, config.archive_volumes - store_count)
+    volumes = []
+    for volume in schedule_volumes(compress_files, compress_sizes, compress_count):
+        volumes.append((archive_profiles[config.archive_profile], volume))
+    for volume in schedule_volumes(store_files, store_sizes, store_count):
+        volumes.append((archive_profiles["store"], volume))
+    if not volumes:
+        volumes.append((archive_profiles[config.archive_profile], []))
+    return volumes
+
+
+# Split volumes so each holds files from one drive - streamed archives store paths without the drive, so the same path on two drives would clash
+def split_volumes_by_drive(volumes):
+    drive_volumes = []
+    for profile, volume in volumes:
+        drives = {}
+        for backup_file in volume:
+            drives.setdefault(os.path.splitdrive(backup_file[0])[0].upper(), []).append(backup_file)
+        if not drives:
+            drive_volumes.append((profile, volume))
+        for drive_files in drives.values():
+            drive_volumes.append((profile, drive_files))
+    return drive_volumes
+
+
+# Build each archive volume with its own 7-Zip process in parallel, sharing the threads between them
+def write_volumes(config, volumes, source):
+    log("Writing " + str(len(volumes)) + " archive volume(s)...", "Attempt", version)
+    threads = max(1, config.max_threads // len(volumes))
+    volume_names = []
+    for x in range(len(volumes)):
+        if len(volumes) == 1:
+            volume_names.append(config.backup_time + ".7z")
+        else:
+            volume_names.append(config.backup_time + "." + str(x + 1).zfill(2) + ".7z")
+        for backup_file in volumes[x][1]:
+            config.archive_names[backup_file[0]] = volume_names[x]
+
+    def write_volume(x):
+        profile, volume = volumes[x]
+        archive_name = config.server_directory + config.computer_name + "\\" + volume_names[x]
+        list_file = config.staging_folder + config.backup_time + "." + str(x + 1).zfill(2) + ".txt"
+
+        # Staged files are listed relative to the staging folder so the archive layout matches a single volume
+        if source == "staged":
+            volume = [(os.path.relpath(get_staging_path(backup_file[0], config.staging_folder, config.backup_time), config.staging_folder),) for backup_file in volume]
+            command = "7z a -t7z -mhc=on -mhe=on " + profile + " -scsUTF-8 -mmt=" + str(threads) + " \"" + archive_name + "\" \"@" + list_file + "\" -p" + config.archive_password
+        else:
+            command = "7z a -t7z -mhc=on -mhe=on " + profile + " -spf2 -scsUTF-8 -mmt=" + str(threads) + " \"" + archive_name + "\" \"@" + list_file + "\" -p" + config.archive_password
+        write_archive_list(volume, list_file)
+        command, creationflags = get_low_priority_command(command)
+        return subprocess.call(command, shell=True, cwd=config.staging_folder, stdout=config.FNULL, stderr=subprocess.STDOUT, creationflags=creationflags)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(volumes), config.max_threads)) as executor:
+        outputs = list(executor.map(write_volume, range(len(volumes))))
+    log("Archive volume(s) written successfully.", "Success", version)
+    return outputs
+
+
+# Write files whose content is not yet in the chunk store, then record this run's manifest
+def chunk_archive(config):
+    log("Writing changed files to chunk store...", "Attempt", version)
+    if config.chunk_repository == "":
+        config.chunk_repository = os.path.join(config.server_directory + config.computer_name, "chunks")
+    manage_chunk_db(config, "open", version)
+    manage_chunk_db(config, "close", version)
+    query_data = (config.chunk_db_name,)
+    config.tracker_db_cursor.execute("ATTACH ? as backutil_chunks", query_data)
+    
+    # Only one file per new content hash needs chunking, whether or not it changed since the last run
+    files_to_store = config.tracker_db_cursor.execute("SELECT file, hash, 'None' AS date FROM backutil_tracker WHERE NOT EXISTS (SELECT 1 FROM backutil_chunks.backutil_chunk_files AS chunk_files WHERE chunk_files.hash = backutil_tracker.hash) GROUP BY hash;").fetchall()
+    sizes = [get_file_size(backup_file[0], config.file_stats) for backup_file in files_to_store]
+    batches = schedule_batches(files_to_store, sizes, config.max_threads)
+    combined_dict = {}
+    bytes_written = [0, 0]
+    
+    # Record each file's chunk list as batches complete
+    def consume_batch(batch_output):
+        query_data = []
+        for key, value in batch_output.items():
+            query_data.append((key, value[0], value[1]))
+            combined_dict[key] = "Y"
+            bytes_written[0] += value[0]
+            bytes_written[1] += value[2]
+        config.tracker_db_cursor.executemany("INSERT OR IGNORE INTO backutil_chunks.backutil_chunk_files (hash, size, chunks) VALUES (?, ?, ?);", query_data)
+        checkpoint(config)
+    run_worker_pool(config, "chunk", store_chunks, batches, (config.chunk_repository, config.hash_algorithm,), consume_batch, "Chunk store thread failed.")
+    
+    # Manifest lists every file in this run, so any run can be restored on its own
+    query_data = (config.backup_time,)
+    config.tracker_db_cursor.execute("INSERT INTO backutil_chunks.backutil_manifest (date, file, hash) SELECT ?, file, hash FROM backutil_tracker WHERE EXISTS (SELECT 1 FROM backutil_chunks.backutil_chunk_files AS chunk_files WHERE chunk_files.hash = backutil_tracker.hash);", query_data)
+    
+    # A backup of only changed paths carries the rest of the last manifest forward
+    if config.partial_scan == "True":
+        load_temp_files(config.tracker_db_cursor, "backutil_dirty", config.dirty_files)
+        query_data = (config.backup_time, config.backup_time,)
+        config.tracker_db_cursor.execute("INSERT INTO backutil_chunks.backutil_manifest (date, file, hash) SELECT ?, file, hash FROM backutil_chunks.backutil_manifest WHERE date = (SELECT MAX(date) FROM backutil_chunks.backutil_manifest WHERE date < ?) AND file NOT IN (SELECT file FROM backutil_tracker) AND file NOT IN (SELECT file FROM temp.backutil_dirty);", query_data)
+    config.tracker_db_conn.commit()
+    config.tracker_db_cursor.execute("DETACH backutil_chunks")
+    msg = "Files written to chunk store (" + str(len(combined_dict)) + " files, " + str(bytes_written[0] // 1048576) + " MB new content, " + str(bytes_written[1] // 1048576) + " MB chunks written)."
+    log(msg, "Success", version)
+    return combined_dict
+
+
 # Main routine - gathers files, adds to 7-Zip, copies to backup directory
 def backup(config):
     
-    # Get list of files and folders
-    log("Getting backup list...", "Attempt", version)
-    backup_list = []
-    backup_list_file = open(config.backup_list_file)
-    for line in backup_list_file:
-        if line[-1] == "\n":
-            backup_list.append(line[:-1])
-        else:
-            backup_list.append(line)
-    backup_list_file.close()
-    log("Backup list read successfully.", "Success", version)
-
-    # Generate list of all files/folders
-    log("Generating list of files in backup directories...", "Attempt", version)
-    backup_files = []
-    for folder in backup_list:
-        for root, directories, filenames in os.walk(folder):
-            for filename in filenames: 
-                backup_files.append(os.path.join(root,filename))
-    log("File list generated successfully.", "Success", version)
+    # An interrupted session continues with its own settings and file list
+    resuming = False
+    if config.checkpoint == "True" and config.resume == "True":
+        load_session(config, version)
+        resuming = config.resume == "True"
+    backup_files = get_backup_files(config, resuming)
+    create_session(config, resuming)
+    hash_backup_files(config, backup_files, resuming)
+    archive_backup_files(config, resuming)
+
+
+# Get list of files and folders - from the checkpoint journal, the watcher's dirty set or a full scan
+def get_backup_files(config, resuming):
+    start = time.perf_counter()
+    if resuming:
+        log("Getting file list from checkpoint journal...", "Attempt", version)
+        backup_files = [row[0] for row in config.tracker_db_cursor.execute("SELECT file FROM backutil_journal;")]
+        if config.partial_scan == "True":
+            load_dirty_files(config, backup_files, version)
+        log("File list read successfully (" + str(len(backup_files)) + " files).", "Success", version)
+    else:
+        log("Getting backup list...", "Attempt", version)
+        backup_list, include_patterns, exclude_patterns = read_backup_list(config.backup_list_file)
+        log("Backup list read successfully.", "Success", version)
+
+        # Incremental backups in watch mode only need the paths the watcher saw change
+        backup_files = None
+        if config.watch == "True" and config.incremental == "True":
+            log("Getting changed files from dirty set...", "Attempt", version)
+            try:
+                backup_files = get_dirty_files(config, backup_list, include_patterns, exclude_patterns, version)
+            except:
+                log("Error reading dirty set, running a full scan.", "Warning", version)
+                config.partial_scan = "False"
+
+        # Generate list of all files/folders
+        if backup_files is None:
+            log("Generating list of files in backup directories...", "Attempt", version)
+            backup_files = enumerate_files(config, backup_list, include_patterns, exclude_patterns, version)
+        set_journal_state(config, backup_files, "enumerated")
+    record_phase(config, "enumerate", start, len(backup_files), sum_file_sizes(backup_files, config.file_stats))
+    return backup_files
+
+
+# Set the backup time and create the staging and session folders
+def create_session(config, resuming):
     
-    log("Generating hashes for backup files...", "Attempt", version)
+    # Streamed archives and the chunk store read straight from the source files, so nothing is staged
+    if config.archive_mode != "staged" and config.pipeline == "True":
+        log("Pipeline mode stages files, so is ignored for this archive mode.", "Warning", version)
+        config.pipeline = "False"
+
+    # Create staging folder before hashing, as pipeline mode stages files while hashing
+    if not resuming:
+        current_time = time.localtime()
+        config.backup_time = time.strftime('%Y-%m-%d-%H%M', current_time)
+
+    log("Creating backup and session folders...", "Attempt", version)
+    try:
+        os.mkdir(config.staging_folder)
+    except:
+        log("Error creating backup folder (or already exists).", "Warning", version)
+    if config.archive_mode == "staged":
+        try:
+            os.mkdir(config.staging_folder + config.backup_time)
+        except:
+            log("Error creating session folder (or already exists).", "Warning", version)
+    log("Backup and session folders created successfully.", "Success", version)
+    if config.checkpoint == "True" and not resuming:
+        save_session(config, "enumerated")
+
+
+# Hash files not in the hash cache and add every file's hash to the tracker DB
+def hash_backup_files(config, backup_files, resuming):
+
+    # Skip files whose stat signature matches the persistent hash cache
+    cached_hashes = {}
+    files_to_hash = backup_files
+    if config.hash_cache == "True":
+        start = time.perf_counter()
+        try:
+            cached_hashes, files_to_hash = get_cached_hashes(config, backup_files, version)
+        except:
+            log("Error checking hash cache, all files will be hashed.", "Warning", version)
+            cached_hashes = {}
+            files_to_hash = backup_files
+        record_phase(config, "cache_check", start, len(backup_files), 0)
+
+    # Files hashed before the interruption are already in the tracker DB
+    hashed_files = set()
+    if resuming:
+        hashed_files = set(row[0] for row in config.tracker_db_cursor.execute("SELECT file FROM backutil_tracker;"))
+        cached_hashes = {key: value for key, value in cached_hashes.items() if key not in hashed_files}
+        files_to_hash = [filename for filename in files_to_hash if filename not in hashed_files]
+        log(str(len(hashed_files)) + " files already hashed before the interruption.", "Success", version)
     
-    # Split backup_files and generate hashes in multiple subprocesses
-    split_backup_files = (backup_files[i::config.max_threads] for i in range(config.max_threads))
-    process_container = []
-    manager = multiprocessing.Manager()
-    return_dict = manager.dict()
-    x = 1
-    for backup_files_thread in split_backup_files:
-        name = "Process-" + str(x)
-        process = multiprocessing.Process(target=generate_hashes, name=name, args=(x, backup_files_thread, return_dict, version,))
-        process_container.append(process)
-        process.start()
-        x += 1
-    for process in process_container:
-        process.join()
-    for process in process_container:
-        if process.exitcode == 0:
-            continue
-        else:
-            log("Hash generation thread failed.", "Failure", version)
-            sys.exit()
+    log("Generating hashes for backup files...", "Attempt", version)
     
-    # Add output from subprocesses to tracker DB
-    combined_dict = {}
-    for dictionary in return_dict.values():
-        for key, value in dictionary.items():
-            combined_dict[key] = value
-    for key, value in combined_dict.items():
-        query_data = (key, value,)
-        config.tracker_db_cursor.execute("INSERT INTO backutil_tracker (file, hash) VALUES (?, ?);", query_data)
+    # Batch files_to_hash by size and generate hashes in the worker pool
+    sizes = [get_file_size(filename, config.file_stats) for filename in files_to_hash]
+    batches = schedule_batches(files_to_hash, sizes, config.max_threads)
+
+    # Worker output is inserted into the tracker DB as each batch completes, in a single transaction
+    if config.pipeline == "True":
+        consume_batch = lambda batch_output: insert_tracker_batch(config, batch_output, 1, "staged")
+    else:
+        consume_batch = lambda batch_output: insert_tracker_batch(config, batch_output, 1)
+    if config.pipeline == "True":
+        run_worker_pool(config, "hash", hash_and_copy_files, batches, (config.staging_folder, config.backup_time, config.hash_algorithm, config.hash_buffer * 1024,), consume_batch, "Hash generation thread failed.")
+    else:
+        run_worker_pool(config, "hash", generate_hashes, batches, (config.hash_algorithm, config.hash_buffer * 1024,), consume_batch, "Hash generation thread failed.")
+    start = time.perf_counter()
+    insert_tracker_batch(config, cached_hashes, 0)
     config.tracker_db_conn.commit()
+    if config.checkpoint == "True" and config.session_state == "enumerated":
+        save_session(config, "hashed")
+    record_phase(config, "tracker_insert", start, len(cached_hashes), 0)
     
+    # Refresh the hash cache from the newly hashed rows in the tracker DB
+    if config.hash_cache == "True":
+        start = time.perf_counter()
+        try:
+            update_hash_cache(config, hashed_files, version)
+        except:
+            log("Error updating hash cache.", "Warning", version)
+        record_phase(config, "cache_update", start, len(files_to_hash), 0)
     log("Hashes generated successfully.", "Success", version)
+
+
+# Diff hashes against previous backups, archive changed files and record them in the previous backups DB and catalog
+def archive_backup_files(config, resuming):
+    staged_files = set()
+    if config.pipeline == "True":
+        for row in config.tracker_db_cursor.execute("SELECT file FROM backutil_tracker WHERE hashed = 1;"):
+            staged_files.add(row[0])
     
     # Get previous hashes if incremental
+    start = time.perf_counter()
     if config.incremental == "True":
         try:
             get_prev_hashes(config, version)
@@ -145,73 +626,92 @@ def backup(config):
         results = config.tracker_db_cursor.execute("SELECT file, hash, 'None' AS date FROM backutil_tracker;")
         for line in results:
             config.files_to_back_up.append(line)
+    record_phase(config, "diff", start, len(config.files_to_back_up), 0)
     
-    # Create staging folder and copy files, make list
-    current_time = time.localtime()
-    config.backup_time = time.strftime('%Y-%m-%d-%H%M', current_time)
+    # In pipeline mode, keep staged copies of changed files and discard the rest
+    files_to_copy = config.files_to_back_up
+    staged_dict = {}
+    if config.pipeline == "True":
+        log("Discarding staged copies of unchanged files...", "Attempt", version)
+        files_to_copy = []
+        for backup_file in config.files_to_back_up:
+            if backup_file[0] in staged_files:
+                staged_dict[backup_file[1]] = "Y"
+                staged_files.discard(backup_file[0])
+            else:
+                files_to_copy.append(backup_file)
+        for filename in staged_files:
+            discard_staged_file(filename, config.staging_folder, config.backup_time)
+        log("Staged copies of unchanged files discarded.", "Success", version)
 
-    log("Creating backup and session folders...", "Attempt", version)
-    try:
-        os.mkdir(config.staging_folder)
-    except:
-        log("Error creating backup folder (or already exists).", "Warning", version)
-    try:
-        os.mkdir(config.staging_folder + config.backup_time)
-    except:
-        log("Error creating session folder (or already exists).", "Warning", version)
-    log("Backup and session folders created successfully.", "Success", version)
+    # Files copied before the interruption are already in the session folder
+    elif resuming and config.archive_mode == "staged":
+        staged_files = set(get_journal_files(config, "staged"))
+        files_to_copy = []
+        for backup_file in config.files_to_back_up:
+            if backup_file[0] in staged_files:
+                staged_dict[backup_file[1]] = "Y"
+            else:
+                files_to_copy.append(backup_file)
+        log(str(len(config.files_to_back_up) - len(files_to_copy)) + " files already staged before the interruption.", "Success", version)
     
-    log("Copying files to session folder...", "Attempt", version)
-        
-    # Split files to be backed up and copy in several subprocesses
-    split_files_to_back_up = (config.files_to_back_up[i::config.max_threads] for i in range(config.max_threads))
-    process_container = []
-    manager = ""
-    return_dict = ""
-    manager = multiprocessing.Manager()
-    return_dict = manager.dict()
-    x = 1
-    for files_to_back_up_thread in split_files_to_back_up:
-        name = "Process-" + str(x)
-        process = multiprocessing.Process(target=copy_files, name=name, args=(x, files_to_back_up_thread, config.staging_folder, config.backup_time, return_dict, version,))
-        process_container.append(process)
-        process.start()
-        x += 1
-    for process in process_container:
-        process.join()
-    for process in process_container:
-        if process.exitcode == 0:
-            continue
-        else:
-            log("File copy thread failed.", "Failure", version)
-            sys.exit()
-
-    # Recombine subprocess output (successfully copied files) ready to add to previous DB
-    combined_dict = {}
-    for dictionary in return_dict.values():
-        for key, value in dictionary.items():
-            combined_dict[key] = value
-                       
-    log("Files copied to session folder successfully.", "Success", version)
+    # A partly written archive from the interrupted session is rebuilt from scratch
+    if resuming and config.session_state != "archived" and config.archive_mode != "chunks":
+        for archive_file in get_backup_archives(config).get(config.backup_time, []):
+            try:
+                os.remove(archive_file)
+            except:
+                pass
 
-    # Archive and password protect .7z
-    log("Creating .7z archive...", "Attempt", version)
-    command = "7z a -t7z -mhc=on -mhe=on -mmt=" + str(config.max_threads) + " \"" + config.server_directory + config.computer_name + "\\" + config.backup_time + ".7z\" " + config.staging_folder + config.backup_time +" -p" + config.archive_password
-    subprocess.call(command, shell=True, stdout=config.FNULL, stderr=subprocess.STDOUT)
-    log("7z archive created.", "Success", version)
+    # Build the archive from the staging folder, or straight from the source files
+    if resuming and config.session_state == "archived":
+        log("Archive already created before the interruption.", "Success", version)
+        archived_files = set(get_journal_files(config, "archived"))
+        config.archive_names = dict(config.tracker_db_cursor.execute("SELECT file, archive FROM backutil_journal WHERE state = 'archived' AND archive IS NOT NULL;").fetchall())
+        combined_dict = {}
+        for backup_file in config.files_to_back_up:
+            if backup_file[0] in archived_files:
+                combined_dict[backup_file[1]] = "Y"
+    elif config.archive_mode == "chunks":
+        combined_dict = chunk_archive(config)
+    elif config.archive_mode == "stream":
+        combined_dict = stream_archive(config, files_to_copy)
+    else:
+        combined_dict = staged_archive(config, files_to_copy, staged_dict)
+    if config.checkpoint == "True" and config.session_state != "archived":
+        set_journal_state(config, (backup_file[0] for backup_file in config.files_to_back_up if backup_file[1] in combined_dict), "archived")
+        config.tracker_db_cursor.executemany("UPDATE backutil_journal SET archive = ? WHERE file = ?;", ((value, key) for key, value in config.archive_names.items()))
+        save_session(config, "archived")
 
-    # Write backed up hashes to DB
+    # Write backed up hashes and the catalog in one transaction - hashes recorded without catalog entries would never be archived again
     log("Writing hashes to DB...", "Attempt", version)
+    start = time.perf_counter()
+    entry_count = 0
     try:
         manage_previous_db(config, "open", version)
-        for key, value in combined_dict.items():
-            query_data = (config.backup_time, key)
-            config.previous_db_cursor.execute("INSERT INTO backutil_previous (date, hash) VALUES (?, ?);", query_data)
-        config.previous_db_conn.commit()
-        manage_previous_db(config, "close", version)             
-        log("Hashes written to DB successfully.", "Success", version)
+        try:
+            query_data = ((config.backup_time, key, config.hash_algorithm) for key in combined_dict.keys())
+            config.previous_db_cursor.executemany("INSERT INTO backutil_previous (date, hash, algorithm) VALUES (?, ?, ?);", query_data)
+            log("Hashes written to DB successfully.", "Success", version)
+            record_phase(config, "db_write", start, len(combined_dict), 0)
+
+            # Record every file in the catalog, so restores can find the archive holding each one
+            start = time.perf_counter()
+            entry_count = write_catalog(config, combined_dict, version)
+            config.previous_db_conn.commit()
+        finally:
+            manage_previous_db(config, "close", version)
     except:
-        log("Error writing hashes to DB.", "Warning", version)
+        log("Error writing hashes and catalog to DB, changed files will be backed up again next time.", "Warning", version)
+    record_phase(config, "catalog", start, entry_count, 0)
+
+    # Changes covered by this backup no longer need to be picked up by the next one
+    if config.watch == "True" and config.incremental == "True":
+        try:
+            finish_dirty_set(config, version)
+        except:
+            log("Error updating dirty set.", "Warning", version)
+    config.session_state = "complete"
 
 
 # Deletes temporary files
@@ -219,8 +719,22 @@ def delete_temp(config):
     # Delete folder on client machine
     log("Deleting temporary files from session folder...", "Attempt", version)
     try:
-        command = "rmdir /s /q " + "\"" + config.staging_folder + config.backup_time + "\""
-        subprocess.call(command, shell=True, stdout=config.FNULL, stderr=subprocess.STDOUT)
+        if config.backup_time == "":
+            pass
+        elif config.archive_mode == "chunks":
+            pass
+        else:
+            # Archive volume list files sit beside the session folder
+            for filename in os.listdir(config.staging_folder):
+                if filename.startswith(config.backup_time + ".") and filename.endswith(".txt"):
+                    os.remove(config.staging_folder + filename)
+            if config.archive_mode == "stream":
+                pass
+            elif config.copy_engine == "native" or config.pipeline == "True":
+                shutil.rmtree(config.staging_folder + config.backup_time)
+            else:
+                command = "rmdir /s /q " + "\"" + config.staging_folder + config.backup_time + "\""
+                subprocess.call(command, shell=True, stdout=config.FNULL, stderr=subprocess.STDOUT)
     except:
         pass
     log("Temporary files deleted successfully.", "Success", version)
@@ -228,29 +742,40 @@ def delete_temp(config):
     
 # If backups require rotation, delete the oldest backup
 def rotate_backups(config):
+    # The chunk store keeps manifests rather than archive files, so is pruned instead
+    start = time.perf_counter()
+    if config.archive_mode == "chunks":
+        prune_chunk_store(config, version)
+        record_phase(config, "rotate", start, 0, 0)
+        return
     log("Deleting previous backups in line with rotation configuration...", "Attempt", version) 
     
     # Only runs if backups need to be rotated    
     if config.too_many_backups > 0:
         
-        # Get list of existing backup files
-        backup_files = []
-        backup_directory = config.server_directory + config.computer_name
-        for root, directories, filenames in os.walk(backup_directory):
-            for filename in filenames: 
-                if ".7z" in filename:
-                    backup_files.append(os.path.join(root,filename))
-
-        # Get ages and add to dictionary
+        # Get list of existing backups
+        backup_archives = get_backup_archives(config)
+
+        # Get ages (of each backup's oldest volume) and add to dictionary
         backup_files_dic = {}
-        for backup_file in backup_files:
-            file_create = os.path.getctime(backup_file)
-            backup_files_dic[backup_file] = file_create
+        for backup_name, backup_files in backup_archives.items():
+            file_create = min(os.path.getctime(backup_file) for backup_file in backup_files)
+            backup_files_dic[backup_name] = file_create
             
-        # Identify and remove oldest backup
+        # Identify and remove oldest backup, including all of its volumes
         oldest_backup = sorted(backup_files_dic.items(), key = lambda kv: kv[1])[0]
-        command = "del /f /s /q /a " + oldest_backup[0]
-        subprocess.call(command, shell=True, stdout=config.FNULL, stderr=subprocess.STDOUT)
+        oldest_backup_size = 0
+        for backup_file in backup_archives[oldest_backup[0]]:
+            oldest_backup_size += os.path.getsize(backup_file)
+            command = "del /f /s /q /a " + backup_file
+            subprocess.call(command, shell=True, stdout=config.FNULL, stderr=subprocess.STDOUT)
+        record_phase(config, "rotate", start, len(backup_archives[oldest_backup[0]]), oldest_backup_size)
+        
+        # Retained backups' catalog entries may still point at the deleted archive
+        try:
+            expire_catalog(config, oldest_backup[0], version)
+        except:
+            log("Error updating catalog for rotated backup.", "Warning", version)
             
         log("Previous backups deleted in line with rotation configuration.", "Success", version)  
             
@@ -278,6 +803,39 @@ def main():
         max_threads = int(config_file['LOCAL']['max_threads'])
         too_many_backups = 0
         config = Config(computer_name, backup_list_file, staging_folder, archive_password, server_directory, backups_rotated, backups_retained, too_many_backups, incremental, max_threads)
+        config.hash_cache = str(config_file['LOCAL'].get('hash_cache', config.hash_cache))
+        config.copy_engine = str(config_file['LOCAL'].get('copy_engine', config.copy_engine))
+        if config.copy_engine not in copy_engines:
+            raise ValueError("Unknown copy engine: " + config.copy_engine)
+        config.pipeline = str(config_file['LOCAL'].get('pipeline', config.pipeline))
+        config.archive_mode = str(config_file['LOCAL'].get('archive_mode', config.archive_mode))
+        if config.archive_mode not in archive_modes:
+            raise ValueError("Unknown archive mode: " + config.archive_mode)
+        config.chunk_repository = str(config_file['LOCAL'].get('chunk_repository', config.chunk_repository))
+        config.parallel_walk = str(config_file['LOCAL'].get('parallel_walk', config.parallel_walk))
+        config.hash_algorithm = str(config_file['LOCAL'].get('hash_algorithm', config.hash_algorithm))
+        if config.hash_algorithm not in hash_algorithms:
+            raise ValueError("Unknown or unavailable hash algorithm: " + config.hash_algorithm)
+        config.hash_buffer = int(config_file['LOCAL'].get('hash_buffer', config.hash_buffer))
+        config.log_level = str(config_file['LOCAL'].get('log_level', config.log_level))
+        config.log_format = str(config_file['LOCAL'].get('log_format', config.log_format))
+        configure_logging(config.log_level, config.log_format)
+        config.metrics_file = str(config_file['LOCAL'].get('metrics_file', config.metrics_file))
+        config.metrics_prom_file = str(config_file['LOCAL'].get('metrics_prom_file', config.metrics_prom_file))
+        config.checkpoint = str(config_file['LOCAL'].get('checkpoint', config.checkpoint))
+        config.archive_volumes = int(config_file['LOCAL'].get('archive_volumes', config.archive_volumes))
+        config.archive_profile = str(config_file['LOCAL'].get('archive_profile', config.archive_profile))
+        if config.archive_profile not in archive_profiles:
+            raise ValueError("Unknown compression profile: " + config.archive_profile)
+        config.store_compressed = str(config_file['LOCAL'].get('store_compressed', config.store_compressed))
+        config.throttle_read = float(config_file['LOCAL'].get('throttle_read', config.throttle_read))
+        config.throttle_write = float(config_file['LOCAL'].get('throttle_write', config.throttle_write))
+        config.throttle_iops = float(config_file['LOCAL'].get('throttle_iops', config.throttle_iops))
+        config.throttle_nice = str(config_file['LOCAL'].get('throttle_nice', config.throttle_nice))
+        config.throttle_schedule = str(config_file['LOCAL'].get('throttle_schedule', config.throttle_schedule))
+        config.watch = str(config_file['LOCAL'].get('watch', config.watch))
+        config.full_scan_interval = float(config_file['LOCAL'].get('full_scan_interval', config.full_scan_interval))
+        config.max_profiles = int(config_file['LOCAL'].get('max_profiles', config.max_profiles))
         log("Configuration loaded successfully.", "Success", version)
     except:
         log("Error loading configuration.", "Failure", version)
@@ -287,20 +845,87 @@ def main():
     except:
         log("Invalid command line arguments.", "Failure", version)
         sys.exit()
+    # The chunk store is written unencrypted, so it cannot hold password-protected backups
+    if config.archive_mode == "chunks" and config.archive_password != "":
+        log("Chunks mode does not encrypt the chunk store, so cannot be used while archive_pass is set.", "Failure", version)
+        sys.exit()
+    try:
+        configure_throttle(config.throttle_read, config.throttle_write, config.throttle_iops, config.throttle_nice, config.throttle_schedule)
+    except:
+        log("Invalid throttle configuration.", "Failure", version)
+        sys.exit()
+    # 7z reads every source file itself in stream mode, and its reads and writes are never capped
+    if config.archive_mode == "stream" and throttle_state.buckets is not None:
+        log("Throttle caps don't apply to 7z, which reads every source file in stream mode. Use staged mode or throttle_nice to spare busy disks.", "Warning", version)
+    
+    # Optionally profile the run, saving stats even if the backup fails
+    if config.profile_file != "":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    profile_configs = []
+    if config.profiles != "":
+        try:
+            profile_configs = get_profiles(config_file, config)
+            if len(profile_configs) == 0:
+                raise ValueError("No matching profiles: " + config.profiles)
+        except:
+            log("Error loading profiles.", "Failure", version)
+            sys.exit()
+    try:
+        start_throttle_schedule(config.throttle_iops, version)
+        if config.profiles != "":
+            run_profiles(config, profile_configs)
+        else:
+            run_backup(config)
+    finally:
+        stop_throttle_schedule()
+        if config.profile_file != "":
+            profiler.disable()
+            profiler.dump_stats(config.profile_file)
+        try:
+            write_metrics(config, version)
+        except:
+            log("Error writing run metrics.", "Warning", version)
+    log("Finished.", "Success", version)
+    print("")
+
+
+# Backup routine - runs the backup, cleans up and rotates old backups
+def run_backup(config):
+    open_backup(config)
+    complete_backup(config, backup)
+
+
+# Open the tracker DB and check how many previous backups need rotating
+def open_backup(config):
     try:
         manage_tracker_db(config, "open", version)
     except:
-        log("Error creating tracker DB in memory.", "Failure", version)  
+        log("Error creating tracker DB.", "Failure", version)  
         sys.exit()
     if config.backups_rotated == "True":
         try:
             check_backups(config)
         except:
             log("Error checking previous backups.", "Failure", version)    
+
+
+# Run a backup routine, then clean up and rotate old backups - a failed backup keeps its checkpoint journal
+def complete_backup(config, backup_routine, *args):
     try:
-        backup(config)
+        backup_routine(config, *args)
     except:
         log("Error during backup.", "Failure", version)
+
+        # Keep the session folder and journal so the backup can be continued with --resume
+        if config.checkpoint == "True":
+            try:
+                config.tracker_db_conn.commit()
+                config.tracker_db_conn.close()
+                log("Progress saved to checkpoint journal. Run with --resume to continue.", "Warning", version)
+            except:
+                log("Error saving checkpoint journal.", "Failure", version)
+            sys.exit()
         try:
             delete_temp(config)
         except:
@@ -318,9 +943,127 @@ def main():
     try:
         manage_tracker_db(config, "close", version)
     except:
-        log("Error creating tracker DB.", "Failure", version)  
-    log("Finished.", "Success", version)
-    print("")
+        log("Error closing tracker DB.", "Failure", version)  
+
+
+# Read the profiles to run - [PROFILE:<name>] sections, each with its own backup list, rotation and incremental settings
+def get_profiles(config_file, config):
+    profile_configs = []
+    for section in config_file.sections():
+        if not section.startswith("PROFILE:"):
+            continue
+        name = section[len("PROFILE:"):]
+        if config.profiles != "all" and name not in config.profiles.split(","):
+            continue
+        backup_list_file = str(config_file[section]['backup_list'])
+        backups_rotated = str(config_file[section].get('rotation', config.backups_rotated))
+        backups_retained = int(config_file[section].get('retained', config.backups_retained))
+        incremental = str(config_file[section].get('incremental', config.incremental))
+
+        # Each profile stages in its own folder, so sessions started in the same minute do not mix
+        profile_config = Config(name, backup_list_file, config.staging_folder + name + os.sep, config.archive_password, config.server_directory, backups_rotated, backups_retained, 0, incremental, config.max_threads)
+        for setting in profile_settings:
+            setattr(profile_config, setting, getattr(config, setting))
+        profile_configs.append(profile_config)
+    return profile_configs
+
+
+# Multi-profile routine - enumerates and hashes the files of every profile once, then diffs and archives each profile
+def run_profiles(config, profile_configs):
+    if config.pipeline == "True":
+        log("Pipeline mode stages files per backup, so is ignored for multi-profile backups.", "Warning", version)
+        config.pipeline = "False"
+
+    # The hashes are shared through an in-memory tracker DB and a hash cache of their own
+    config.checkpoint = "False"
+    if config.cache_db_name == "":
+        config.cache_db_name = config.computer_name + "_shared.sqlite"
+    manage_tracker_db(config, "open", version)
+    config.worker_pool = start_worker_pool(config.max_threads)
+    config.walk_cache = {}
+    try:
+        profile_files = {}
+        resuming_profiles = []
+        for profile_config in profile_configs:
+            log("Opening profile " + profile_config.computer_name + "...", "Attempt", version)
+            profile_config.worker_pool = config.worker_pool
+            profile_config.walk_cache = config.walk_cache
+            open_backup(profile_config)
+
+            # An interrupted profile continues on its own from its checkpoint journal
+            if profile_config.checkpoint == "True" and profile_config.resume == "True":
+                if profile_config.tracker_db_cursor.execute("SELECT value FROM backutil_session WHERE key = 'backup_time';").fetchone() is not None:
+                    resuming_profiles.append(profile_config)
+                    log("Profile " + profile_config.computer_name + " will resume its interrupted session.", "Success", version)
+                    continue
+                load_session(profile_config, version)
+            profile_files[profile_config.computer_name] = get_backup_files(profile_config, False)
+            config.file_stats.update(profile_config.file_stats)
+
+            # Files outside the dirty set of a partial scan keep their hash cache entries
+            if profile_config.partial_scan == "True":
+                config.partial_scan = "True"
+                config.dirty_files += profile_config.dirty_files
+            log("Profile " + profile_config.computer_name + " opened successfully.", "Success", version)
+
+        # Folder listings are only shared while the profiles are enumerated
+        config.walk_cache = ""
+        for profile_config in profile_configs:
+            profile_config.walk_cache = ""
+
+        # Overlapping profiles only read each file once
+        backup_files = sorted(set(filename for files in profile_files.values() for filename in files))
+        log("Hashing " + str(len(backup_files)) + " files for " + str(len(profile_files)) + " profiles...", "Attempt", version)
+        hash_backup_files(config, backup_files, False)
+        hashes = dict(config.tracker_db_cursor.execute("SELECT file, hash FROM backutil_tracker;").fetchall())
+
+        # Profiles archived at the same time share max_threads, so their 7-Zip processes stay within the global cap
+        profile_threads = max(1, config.max_threads // max(1, min(config.max_profiles, len(profile_configs))))
+        for profile_config in profile_configs:
+            profile_config.max_threads = profile_threads
+
+        # Profiles are diffed against their own previous backups DB and archived, max_profiles at a time
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_profiles) as executor:
+            futures = {}
+            for profile_config in profile_configs:
+                if profile_config in resuming_profiles:
+                    futures[executor.submit(run_profile, profile_config, backup)] = profile_config
+                else:
+                    futures[executor.submit(run_profile, profile_config, archive_profile, profile_files[profile_config.computer_name], hashes)] = profile_config
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    log("Profile " + futures[future].computer_name + " backed up successfully.", "Success", version)
+                except:
+                    log("Error backing up profile " + futures[future].computer_name + ".", "Failure", version)
+    finally:
+        config.worker_pool.shutdown(wait=True)
+        config.worker_pool = ""
+        manage_tracker_db(config, "close", version)
+
+
+# Back up one profile of a multi-profile run, then write its run metrics
+def run_profile(config, backup_routine, *args):
+    log("Backing up profile " + config.computer_name + "...", "Attempt", version)
+    try:
+        complete_backup(config, backup_routine, *args)
+    finally:
+        try:
+            write_metrics(config, version)
+        except:
+            log("Error writing run metrics.", "Warning", version)
+
+
+# Backup routine for one profile of a multi-profile run - takes its hashes from the shared run, then archives as usual
+def archive_profile(config, backup_files, hashes):
+    create_session(config, False)
+    start = time.perf_counter()
+    insert_tracker_batch(config, {filename: hashes[filename] for filename in backup_files if filename in hashes}, 0)
+    config.tracker_db_conn.commit()
+    if config.checkpoint == "True":
+        save_session(config, "hashed")
+    record_phase(config, "tracker_insert", start, len(backup_files), 0)
+    archive_backup_files(config, False)
      
     
 if __name__ == "__main__": 
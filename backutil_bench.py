@@ -0,0 +1,513 @@
+import os, sys, time, getopt, tempfile, shutil, sqlite3, hashlib, random, json, platform, multiprocessing
+import backutil
+from backutil import version, Config
+from backutil_subfuncs import hash_algorithms, generate_hashes, copy_files_native, hash_and_copy_files, manage_previous_db, configure_logging, get_prev_hashes_query, get_catalog_key
+from backutil_chunkstore import store_chunks
+from backutil_catalog import find_entries, get_catalog_date
+
+# Peak RSS is only available where the resource module is (not on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Synthetic datasets - default file count, then (share of files, min size, max size, max folder depth) for each group
+bench_datasets = {
+    "tiny": (20000, [(1.0, 0, 4096, 3)]),
+    "huge": (4, [(1.0, 67108864, 268435456, 1)]),
+    "deep": (2000, [(1.0, 1024, 65536, 40)]),
+    "mixed": (5000, [(0.9, 0, 16384, 4), (0.099, 65536, 4194304, 6), (0.001, 33554432, 134217728, 2)]),
+}
+
+# Stand-in for 7z - stores every input file in the archive file without compression, so runs need no real 7z
+bench_archiver = """import os, sys
+arguments = [argument for argument in sys.argv[2:] if not argument.startswith("-")]
+inputs = []
+for argument in arguments[1:]:
+    if argument.startswith("@"):
+        with open(argument[1:], encoding="utf-8") as f:
+            inputs += [line.rstrip("\\n") for line in f if line.strip() != ""]
+    elif os.path.isdir(argument):
+        inputs += [os.path.join(root, name) for root, dirs, names in os.walk(argument) for name in names]
+    else:
+        inputs.append(argument)
+with open(arguments[0], "ab") as fdst:
+    for filename in inputs:
+        with open(filename, "rb") as fsrc:
+            while True:
+                data = fsrc.read(1048576)
+                if not data:
+                    break
+                fdst.write(data)
+"""
+
+
+# Print benchmark usage
+def print_usage():
+    print("")
+    print("Usage: backutil_bench.py <benchmark> [options]")
+    print("")
+    print("BENCHMARKS")
+    print("pipeline      | Two-phase hash/copy vs single-read pipeline")
+    print("diff          | Incremental diff query, unindexed vs indexed DB")
+    print("chunks        | Bytes written for a small edit to one large file")
+    print("hashes        | Hashing throughput for each available algorithm")
+    print("catalog       | Catalog lookups of a file and a folder as of a date")
+    print("backup        | Full and incremental backups of a synthetic dataset")
+    print("compare       | Compares stored backup benchmark results by label")
+    print("")
+    print("OPTIONS")
+    print("--files <no>  | -f <no>   | Sets number of files to generate (backup defaults per dataset)")
+    print("--size <kb>   | -s <kb>   | Sets size of each file in KB (chunks 65536, hashes 1048576)")
+    print("--rows <no>   | -r <no>   | Sets number of previous DB rows")
+    print("--buffer <kb> | -b <kb>   | Sets hash read buffer size in KB")
+    print("--dataset <n> | -d <name> | Sets synthetic dataset (tiny/huge/deep/mixed, default mixed)")
+    print("--seed <no>   | -S <no>   | Sets random seed for the synthetic dataset (default 1)")
+    print("--churn <%>   | -c <%>    | Sets percentage of files changed before the incremental run (default 1)")
+    print("--results <f> | -o <file> | Sets file backup results are appended to (default bench_results.jsonl)")
+    print("--label <l>   | -t <l>    | Labels backup results for comparison (default version)")
+    print("")
+
+
+# Print a single benchmark result line
+def print_result(name, seconds, bytes_read):
+    throughput = (bytes_read / 1048576) / seconds if seconds > 0 else 0
+    print(name.ljust(12) + " | " + ("%.3f s" % seconds).rjust(10) + " | " + ("%.1f MB read" % (bytes_read / 1048576)).rjust(14) + " | " + ("%.1f MB/s" % throughput).rjust(12))
+
+
+# Create a folder of random files for benchmarking
+def make_files(folder, file_count, file_size):
+    files = []
+    os.makedirs(folder, exist_ok=True)
+    for x in range(file_count):
+        filename = os.path.join(folder, "file_" + str(x) + ".bin")
+        with open(filename, "wb") as f:
+            f.write(os.urandom(file_size))
+        files.append(os.path.abspath(filename))
+    return files
+
+
+# Compare two-phase hash then copy against the single-read hash-and-copy pipeline
+def bench_pipeline(file_count, file_size):
+    work_folder = tempfile.mkdtemp(prefix="backutil_bench_")
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_folder)
+        files = make_files("source", file_count, file_size)
+        staging_folder = os.path.join(work_folder, "staging") + os.sep
+        total_bytes = file_count * file_size
+
+        # Two-phase: every file is read once to hash and again to copy
+        io_start = get_io_counters()
+        start = time.perf_counter()
+        hashes = generate_hashes(1, files, "sha256", 65536, version)
+        files_to_back_up = [(key, value, "None") for key, value in hashes.items()]
+        copy_files_native(1, files_to_back_up, staging_folder, "two-phase", version)
+        print_result("two-phase", time.perf_counter() - start, get_bytes_read(io_start, total_bytes * 2))
+
+        # Pipeline: every file is read once, feeding both the hasher and the copy
+        io_start = get_io_counters()
+        start = time.perf_counter()
+        hash_and_copy_files(1, files, staging_folder, "pipeline", "sha256", 65536, version)
+        print_result("pipeline", time.perf_counter() - start, get_bytes_read(io_start, total_bytes))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+# Compare the original LEFT JOIN on an unindexed previous DB against the indexed anti-join
+def bench_diff(row_count):
+    work_folder = tempfile.mkdtemp(prefix="backutil_bench_")
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_folder)
+        
+        # Previous DB holds row_count hashes over five backups, tracker holds the newest backup plus 1% new files
+        backup_dates = 5
+        tracker_count = row_count // backup_dates
+        db_conn = sqlite3.connect("bench.sqlite")
+        db_conn.execute("CREATE TABLE backutil_previous(date TEXT, hash TEXT);")
+        db_conn.executemany("INSERT INTO backutil_previous (date, hash) VALUES (?, ?);", (("2021-01-0" + str(x % backup_dates + 1), hashlib.sha256(str(x).encode()).hexdigest()) for x in range(row_count)))
+        db_conn.commit()
+        db_conn.close()
+        tracker_conn = sqlite3.connect(":memory:")
+        tracker_conn.execute("CREATE TABLE backutil_tracker(file TEXT, hash TEXT, hashed INTEGER);")
+        tracker_conn.executemany("INSERT INTO backutil_tracker (file, hash, hashed) VALUES (?, ?, 1);", (("file_" + str(x), hashlib.sha256(str(x * backup_dates).encode()).hexdigest()) for x in range(tracker_count)))
+        tracker_conn.executemany("INSERT INTO backutil_tracker (file, hash, hashed) VALUES (?, ?, 1);", (("new_" + str(x), hashlib.sha256(("new" + str(x)).encode()).hexdigest()) for x in range(tracker_count // 100)))
+        tracker_conn.commit()
+        tracker_conn.execute("ATTACH 'bench.sqlite' as backutil_previous")
+        print(str(row_count) + " previous rows, " + str(tracker_count + tracker_count // 100) + " tracked files")
+        
+        # Original query, run against the schema before migration
+        start = time.perf_counter()
+        results = tracker_conn.execute("SELECT backutil_tracker.file, backutil_tracker.hash, backutil_previous.date FROM backutil_tracker LEFT JOIN backutil_previous ON backutil_tracker.hash=backutil_previous.hash;")
+        files_to_back_up = [line for line in results if line[2] == None]
+        print_diff_result("left join", time.perf_counter() - start, len(files_to_back_up))
+        tracker_conn.execute("DETACH backutil_previous")
+        
+        # Migrate with indexes and WAL, then run the anti-join
+        config = Config("bench", "", "", "", "", "False", 0, 0, "True", 1)
+        start = time.perf_counter()
+        manage_previous_db(config, "open", version)
+        manage_previous_db(config, "close", version)
+        print_diff_result("migration", time.perf_counter() - start)
+        tracker_conn.execute("ATTACH 'bench.sqlite' as backutil_previous")
+        start = time.perf_counter()
+        files_to_back_up = tracker_conn.execute(get_prev_hashes_query, ("sha256",)).fetchall()
+        print_diff_result("not exists", time.perf_counter() - start, len(files_to_back_up))
+        tracker_conn.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+# Print a single diff benchmark result line
+def print_diff_result(name, seconds, file_count=None):
+    line = name.ljust(12) + " | " + ("%.3f s" % seconds).rjust(10)
+    if file_count is not None:
+        line += " | " + (str(file_count) + " files to back up").rjust(24)
+    print(line)
+
+
+# Fill a catalog with row_count entries over five backups, then time restore lookups
+def bench_catalog(row_count):
+    work_folder = tempfile.mkdtemp(prefix="backutil_bench_")
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_folder)
+        backup_dates = 5
+        config = Config("bench", "", "", "", "", "False", 0, 0, "True", 1)
+        manage_previous_db(config, "open", version)
+        start = time.perf_counter()
+        filenames = ["C:\\data\\" + str(y % 1000).zfill(3) + "\\file_" + str(y) for y in range(row_count // backup_dates)]
+        for x in range(backup_dates):
+            backup_date = "2021-01-0" + str(x + 1) + "-2100"
+            config.previous_db_cursor.executemany("INSERT INTO backutil_catalog (date, file, file_key, size, mtime, hash, algorithm, archive, member) VALUES (?, ?, ?, 1024, 0, ?, 'sha256', ?, ?);", ((backup_date, filename, get_catalog_key(filename), hashlib.sha256(str(y).encode()).hexdigest(), backup_date + ".7z", "file_" + str(y)) for y, filename in enumerate(filenames)))
+        config.previous_db_conn.commit()
+        print(str(row_count) + " catalog entries")
+        print_diff_result("insert", time.perf_counter() - start)
+        
+        # One file across every backup, one folder as of a date, and the date lookup itself
+        start = time.perf_counter()
+        entries = find_entries(config, "C:\\data\\123\\file_123", None)
+        print_catalog_result("file history", time.perf_counter() - start, len(entries))
+        start = time.perf_counter()
+        backup_date = get_catalog_date(config, "2021-01-03")
+        print_catalog_result("date lookup", time.perf_counter() - start, 1)
+        start = time.perf_counter()
+        entries = find_entries(config, "C:\\data\\456\\", backup_date)
+        print_catalog_result("folder", time.perf_counter() - start, len(entries))
+        manage_previous_db(config, "close", version)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+# Print a single catalog benchmark result line
+def print_catalog_result(name, seconds, entry_count):
+    print(name.ljust(12) + " | " + ("%.2f ms" % (seconds * 1000)).rjust(10) + " | " + (str(entry_count) + " entries").rjust(16))
+
+
+# Store one large file in the chunk store, make a small edit and store it again
+def bench_chunks(file_size):
+    work_folder = tempfile.mkdtemp(prefix="backutil_bench_")
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_folder)
+        repository = os.path.join(work_folder, "repository")
+        filename = make_files("source", 1, file_size)[0]
+        
+        # Initial run - every chunk is new
+        file_hash = generate_hashes(1, [filename], "sha256", 65536, version)[filename]
+        start = time.perf_counter()
+        output = store_chunks(1, [(filename, file_hash, "None")], repository, "sha256", version)
+        print_chunk_result("initial", time.perf_counter() - start, file_size, output[file_hash][2])
+        
+        # Insert 4 KB in the middle of the file, shifting everything after it
+        with open(filename, "rb") as f:
+            data = f.read()
+        data = data[:file_size // 2] + os.urandom(4096) + data[file_size // 2:]
+        with open(filename, "wb") as f:
+            f.write(data)
+        file_hash = generate_hashes(1, [filename], "sha256", 65536, version)[filename]
+        start = time.perf_counter()
+        output = store_chunks(1, [(filename, file_hash, "None")], repository, "sha256", version)
+        print_chunk_result("4 KB edit", time.perf_counter() - start, len(data), output[file_hash][2])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+# Print a single chunk store benchmark result line, compared with re-archiving the whole file
+def print_chunk_result(name, seconds, file_size, bytes_written):
+    print(name.ljust(12) + " | " + ("%.3f s" % seconds).rjust(10) + " | " + ("%.1f MB file" % (file_size / 1048576)).rjust(14) + " | " + ("%.2f MB written" % (bytes_written / 1048576)).rjust(16))
+
+
+# Hash the same in-memory data with each available algorithm, to compare CPU cost without disk reads
+def bench_hashes(total_size, buffer_size):
+    data = os.urandom(buffer_size)
+    block_count = max(total_size // buffer_size, 1)
+    for name, new_hash in hash_algorithms.items():
+        file_hash = new_hash()
+        start = time.perf_counter()
+        for x in range(block_count):
+            file_hash.update(data)
+        file_hash.hexdigest()
+        seconds = time.perf_counter() - start
+        throughput = (block_count * buffer_size / 1073741824) / seconds if seconds > 0 else 0
+        print(name.ljust(12) + " | " + ("%.3f s" % seconds).rjust(10) + " | " + ("%.2f GB/s" % throughput).rjust(12))
+
+
+# Generate a reproducible synthetic tree - the same dataset, file count and seed always give the same files
+def make_dataset(folder, dataset, file_count, seed):
+    rng = random.Random(seed)
+    groups = bench_datasets[dataset][1]
+    files = []
+    for x in range(file_count):
+        share = rng.random()
+        for group_share, min_size, max_size, max_depth in groups:
+            share -= group_share
+            if share < 0:
+                break
+        
+        # Folders are shared between files, four to a level, so deep datasets nest rather than fan out
+        depth = rng.randint(0, max_depth)
+        path = [folder] + ["dir_" + str(rng.randrange(4)) for y in range(depth)]
+        os.makedirs(os.path.join(*path), exist_ok=True)
+        filename = os.path.abspath(os.path.join(*(path + ["file_" + str(x) + ".bin"])))
+        write_random_data(filename, rng, rng.randint(min_size, max_size))
+        files.append(filename)
+    return files
+
+
+# Write size bytes of seeded random data to a file, in 1 MB blocks
+def write_random_data(filename, rng, size, mode="wb"):
+    with open(filename, mode) as f:
+        while size > 0:
+            block_size = min(size, 1048576)
+            f.write(rng.randbytes(block_size))
+            size -= block_size
+
+
+# Change a share of the files for the incremental run - each gets new data at its start
+def churn_dataset(files, churn, seed):
+    rng = random.Random(seed + 1)
+    changed = rng.sample(files, max(int(len(files) * churn / 100), 1))
+    for filename in changed:
+        with open(filename, "r+b") as f:
+            f.write(rng.randbytes(min(os.path.getsize(filename), 4096) or 1))
+    return len(changed)
+
+
+# Write the stand-in 7z to a folder that is put first on the PATH
+def make_archiver(folder):
+    os.makedirs(folder, exist_ok=True)
+    script = os.path.join(folder, "7z.py")
+    with open(script, "w") as f:
+        f.write(bench_archiver)
+    if os.name == "nt":
+        with open(os.path.join(folder, "7z.cmd"), "w") as f:
+            f.write("@\"" + sys.executable + "\" \"" + script + "\" %*\n")
+    else:
+        with open(os.path.join(folder, "7z"), "w") as f:
+            f.write("#!" + sys.executable + "\n" + bench_archiver)
+        os.chmod(os.path.join(folder, "7z"), 0o755)
+
+
+# Get the bytes read and written so far by this process and its finished children - Linux only
+def get_io_counters():
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except:
+        return None
+
+
+# Get bytes read since io_start, falling back to the expected figure where /proc/self/io is not available
+def get_bytes_read(io_start, expected_bytes):
+    io_end = get_io_counters()
+    if io_start is None or io_end is None:
+        return expected_bytes
+    return io_end[0] - io_start[0]
+
+
+# Get the peak RSS in MB of this process and of its largest finished child
+def get_peak_rss():
+    if resource is None:
+        return None, None
+    scale = 1048576 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1), round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+
+
+# Run one backup of the dataset in its own process, so peak RSS covers only this run
+def run_bench_backup(work_folder, incremental, result_queue):
+    os.chdir(work_folder)
+    configure_logging("Warning", "csv")
+    io_start = get_io_counters()
+    config = Config("bench", os.path.join(work_folder, "list.txt"), os.path.join(work_folder, "staging") + os.sep, "bench", os.path.join(work_folder, "server") + os.sep, "False", 0, 0, incremental, os.cpu_count() or 1)
+    config.copy_engine = "native"
+    start = time.perf_counter()
+    
+    # A failed backup exits, so the parent is told rather than left waiting for a result
+    try:
+        backutil.run_backup(config)
+    except:
+        result_queue.put(None)
+        return
+    seconds = time.perf_counter() - start
+    io_end = get_io_counters()
+    peak_rss, children_peak_rss = get_peak_rss()
+    result = {"seconds": round(seconds, 3), "files_backed_up": len(config.files_to_back_up), "peak_rss_mb": peak_rss, "children_peak_rss_mb": children_peak_rss, "bytes_read": None, "bytes_written": None}
+    if io_start is not None and io_end is not None:
+        result["bytes_read"] = io_end[0] - io_start[0]
+        result["bytes_written"] = io_end[1] - io_start[1]
+    result["phases"] = [{"phase": phase["phase"], "seconds": phase["seconds"], "files": phase["files"], "bytes": phase["bytes"]} for phase in config.metrics]
+    result_queue.put(result)
+
+
+# Generate a dataset, run a full then an incremental backup of it and append the results to the results file
+def bench_backup(dataset, file_count, seed, churn, results_file, label):
+    work_folder = tempfile.mkdtemp(prefix="backutil_bench_")
+    path = os.environ.get("PATH", "")
+    try:
+        start = time.perf_counter()
+        files = make_dataset(os.path.join(work_folder, "source"), dataset, file_count, seed)
+        total_bytes = sum(os.path.getsize(filename) for filename in files)
+        print(dataset + " dataset, " + str(len(files)) + " files, " + ("%.1f MB" % (total_bytes / 1048576)) + ", generated in " + ("%.1f s" % (time.perf_counter() - start)))
+        with open(os.path.join(work_folder, "list.txt"), "w") as f:
+            f.write(os.path.join(work_folder, "source") + "\n")
+        os.makedirs(os.path.join(work_folder, "server", "bench"))
+        make_archiver(os.path.join(work_folder, "bin"))
+        os.environ["PATH"] = os.path.join(work_folder, "bin") + os.pathsep + path
+        result_queue = multiprocessing.Queue()
+        for run in ("full", "incremental"):
+            if run == "incremental":
+                print("")
+                print(str(churn_dataset(files, churn, seed)) + " files changed")
+            process = multiprocessing.Process(target=run_bench_backup, args=(work_folder, "True", result_queue))
+            process.start()
+            result = result_queue.get()
+            process.join()
+            if result is None:
+                print(run + " run failed.")
+                return
+            result = dict({"label": label, "version": version, "benchmark": "backup", "dataset": dataset, "files": len(files), "bytes": total_bytes, "seed": seed, "churn": churn, "run": run, "time": time.strftime('%Y-%m-%d %H:%M:%S'), "python": platform.python_version(), "platform": platform.platform()}, **result)
+            with open(results_file, "a") as f:
+                f.write(json.dumps(result) + "\n")
+            print_backup_result(result)
+    finally:
+        os.environ["PATH"] = path
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+
+# Print the results of one backup benchmark run, one line per phase
+def print_backup_result(result):
+    print("")
+    print(result["run"] + " run - " + str(result["files_backed_up"]) + " files backed up")
+    for phase in result["phases"]:
+        print(phase["phase"].ljust(14) + " | " + ("%.3f s" % phase["seconds"]).rjust(10) + " | " + ("%.1f MB" % (phase["bytes"] / 1048576)).rjust(12))
+    print("total".ljust(14) + " | " + ("%.3f s" % result["seconds"]).rjust(10))
+    if result["peak_rss_mb"] is not None:
+        print("peak RSS".ljust(14) + " | " + ("%.1f MB" % result["peak_rss_mb"]).rjust(10) + " | " + ("%.1f MB" % result["children_peak_rss_mb"]).rjust(12) + " (largest child)")
+    if result["bytes_read"] is not None:
+        print("IO".ljust(14) + " | " + ("%.1f MB" % (result["bytes_read"] / 1048576)).rjust(10) + " | " + ("%.1f MB" % (result["bytes_written"] / 1048576)).rjust(12) + " (read | written)")
+
+
+# Compare the latest stored result for each label, for every dataset and run in the results file
+def bench_compare(results_file):
+    try:
+        with open(results_file) as f:
+            results = [json.loads(line) for line in f if line.strip() != ""]
+    except:
+        print("No benchmark results found in " + results_file)
+        return
+    comparisons = {}
+    for result in results:
+        key = (result["dataset"], result["files"], result["seed"], result["churn"], result["run"])
+        comparisons.setdefault(key, {})[result["label"]] = result
+    for key, labelled in comparisons.items():
+        labels = list(labelled)
+        print("")
+        print(key[0] + " dataset, " + str(key[1]) + " files, seed " + str(key[2]) + ", " + key[4] + " run")
+        print("".ljust(20) + " | " + " | ".join(label.rjust(12) for label in labels) + ("" if len(labels) < 2 else " | " + "change".rjust(8)))
+        rows = {}
+        for label in labels:
+            for phase in labelled[label]["phases"]:
+                rows.setdefault(phase["phase"] + " (s)", {})[label] = phase["seconds"]
+            rows.setdefault("total (s)", {})[label] = labelled[label]["seconds"]
+            rows.setdefault("peak RSS (MB)", {})[label] = labelled[label]["peak_rss_mb"]
+            rows.setdefault("read (MB)", {})[label] = None if labelled[label]["bytes_read"] is None else round(labelled[label]["bytes_read"] / 1048576, 1)
+            rows.setdefault("written (MB)", {})[label] = None if labelled[label]["bytes_written"] is None else round(labelled[label]["bytes_written"] / 1048576, 1)
+        for name, values in rows.items():
+            line = name.ljust(20) + " | " + " | ".join(("-" if values.get(label) is None else str(values[label])).rjust(12) for label in labels)
+            
+            # Change is from the first label compared to the last
+            first = values.get(labels[0])
+            last = values.get(labels[-1])
+            if len(labels) > 1 and first and last is not None:
+                line += " | " + ("%+.1f%%" % ((last - first) / first * 100)).rjust(8)
+            print(line)
+
+
+# Main routine
+def main():
+    try:
+        benchmark = sys.argv[1]
+        arguments, values = getopt.getopt(sys.argv[2:], "f:s:r:b:d:S:c:o:t:", ["files=", "size=", "rows=", "buffer=", "dataset=", "seed=", "churn=", "results=", "label="])
+    except:
+        print_usage()
+        sys.exit()
+    file_count = 0
+    file_size = 0
+    row_count = 1000000
+    buffer_size = 64
+    dataset = "mixed"
+    seed = 1
+    churn = 1
+    results_file = "bench_results.jsonl"
+    label = version
+    for current_argument, current_value in arguments:
+        if current_argument in ("-f", "--files"):
+            file_count = int(current_value)
+        if current_argument in ("-s", "--size"):
+            file_size = int(current_value)
+        if current_argument in ("-r", "--rows"):
+            row_count = int(current_value)
+        if current_argument in ("-b", "--buffer"):
+            buffer_size = int(current_value)
+        if current_argument in ("-d", "--dataset"):
+            dataset = current_value
+        if current_argument in ("-S", "--seed"):
+            seed = int(current_value)
+        if current_argument in ("-c", "--churn"):
+            churn = float(current_value)
+        if current_argument in ("-o", "--results"):
+            results_file = current_value
+        if current_argument in ("-t", "--label"):
+            label = current_value
+    if file_count == 0:
+        file_count = bench_datasets[dataset][0] if benchmark == "backup" and dataset in bench_datasets else 200
+    if file_size == 0:
+        file_size = 65536 if benchmark == "chunks" else 1048576 if benchmark == "hashes" else 1024
+    file_size = file_size * 1024
+    if benchmark == "pipeline":
+        bench_pipeline(file_count, file_size)
+    elif benchmark == "diff":
+        bench_diff(row_count)
+    elif benchmark == "chunks":
+        bench_chunks(file_size)
+    elif benchmark == "hashes":
+        bench_hashes(file_size, buffer_size * 1024)
+    elif benchmark == "catalog":
+        bench_catalog(row_count)
+    elif benchmark == "backup" and dataset in bench_datasets:
+        bench_backup(dataset, file_count, seed, churn, os.path.abspath(results_file), label)
+    elif benchmark == "compare":
+        bench_compare(results_file)
+    else:
+        print_usage()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os, sys, getopt, sqlite3, subprocess, shutil, time, zlib, configparser, colorama
+from backutil_subfuncs import log, manage_previous_db, get_catalog_key
+from backutil_chunkstore import get_chunk_path
+
+# Upper bound for prefix range lookups - sorts after any path starting with the prefix
+catalog_prefix_end = "\U0010ffff"
+
+
+# Print catalog usage
+def print_usage():
+    print("")
+    print("Usage: backutil_catalog.py find|restore [options]")
+    print("")
+    print("COMMANDS")
+    print("find             | Lists backed up versions of a file or folder")
+    print("restore          | Extracts a file or folder from the backups")
+    print("")
+    print("OPTIONS")
+    print("--name <name>    | -n <name>   | Sets backup folder/record name")
+    print("--path <path>    | -p <path>   | Sets file or folder path (prefix)")
+    print("--date <date>    | -d <date>   | Uses the backup as of this date (default latest)")
+    print("--output <dir>   | -o <dir>    | Sets folder to restore files into")
+    print("")
+
+
+# Get the date of the latest backup in the catalog made on or before a date
+def get_catalog_date(config, backup_date):
+    if backup_date == "":
+        row = config.previous_db_cursor.execute("SELECT MAX(date) FROM backutil_catalog;").fetchone()
+    else:
+        query_data = (backup_date + catalog_prefix_end,)
+        row = config.previous_db_cursor.execute("SELECT MAX(date) FROM backutil_catalog WHERE date <= ?;", query_data).fetchone()
+    return row[0]
+
+
+# Look up catalog entries for a file or folder prefix - in one backup if a date is given, otherwise every version
+def find_entries(config, prefix, backup_date):
+    # A trailing separator still limits the lookup to the folder's contents once the prefix is normalised
+    prefix_key = get_catalog_key(prefix)
+    if prefix.endswith((os.sep, os.altsep or os.sep)) and not prefix_key.endswith(os.sep):
+        prefix_key = prefix_key + os.sep
+    query_data = (prefix_key, prefix_key + catalog_prefix_end,)
+    query = "SELECT date, file, size, mtime, hash, archive, member FROM backutil_catalog WHERE file_key >= ? AND file_key < ?"
+    if backup_date is not None:
+        query_data = query_data + (backup_date,)
+        query = query + " AND date = ?"
+    return config.previous_db_cursor.execute(query + " ORDER BY file, date;", query_data).fetchall()
+
+
+# Get the restore path for a backed up file, using the drive letter as the top folder
+def get_restore_path(filename, output_folder):
+    drive, path = os.path.splitdrive(filename)
+    drive = drive.replace(":", "").replace("\\", "/").strip("/")
+    path = path.replace("\\", "/").lstrip("/")
+    return os.path.join(output_folder, drive, path)
+
+
+# Extract only the needed members from each archive, then move them into place
+def restore_entries(config, entries, output_folder, version):
+    archives = {}
+    for entry in entries:
+        archives.setdefault(entry[5], []).append(entry)
+    restored = 0
+    for archive, archive_entries in archives.items():
+        if archive is None:
+            for entry in archive_entries:
+                log("No archive holds " + entry[1], "Warning", version)
+            continue
+        if archive == "chunks":
+            restored += restore_chunk_entries(config, archive_entries, output_folder, version)
+            continue
+
+        # Each member is extracted once, even if several files share its content
+        log("Extracting " + str(len(archive_entries)) + " file(s) from " + archive + "...", "Attempt", version)
+        temp_folder = os.path.join(output_folder, ".backutil_restore")
+        list_file = os.path.join(output_folder, ".backutil_restore.txt")
+        os.makedirs(temp_folder, exist_ok=True)
+        members = sorted(set(entry[6] for entry in archive_entries))
+        with open(list_file, "w", encoding="utf-8") as f:
+            for member in members:
+                f.write(member + "\n")
+        command = "7z x -y -scsUTF-8 \"" + config.server_directory + config.computer_name + "\\" + archive + "\" -o\"" + temp_folder + "\" \"@" + list_file + "\" -p" + config.archive_password
+        output = subprocess.call(command, shell=True, stdout=config.FNULL, stderr=subprocess.STDOUT)
+        if output not in (0, 1):
+            log("Error extracting from " + archive + ".", "Warning", version)
+        for entry in archive_entries:
+            destination = get_restore_path(entry[1], output_folder)
+            try:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.copy2(os.path.join(temp_folder, entry[6]), destination)
+                restored += 1
+            except:
+                log("Error restoring " + entry[1], "Warning", version)
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        os.remove(list_file)
+        log("Files extracted from " + archive + ".", "Success", version)
+    return restored
+
+
+# Restore catalog entries held in the chunk store by reassembling their chunks
+def restore_chunk_entries(config, entries, output_folder, version):
+    if config.chunk_repository == "":
+        config.chunk_repository = os.path.join(config.server_directory + config.computer_name, "chunks")
+    chunk_db_conn = sqlite3.connect(os.path.join(config.chunk_repository, "index.sqlite"))
+    restored = 0
+    for entry in entries:
+        destination = get_restore_path(entry[1], output_folder)
+        try:
+            query_data = (entry[4],)
+            chunks = chunk_db_conn.execute("SELECT chunks FROM backutil_chunk_files WHERE hash = ?;", query_data).fetchone()[0]
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, "wb") as fdst:
+                for chunk_hash in chunks.split(","):
+                    if chunk_hash == "":
+                        continue
+                    with open(get_chunk_path(config.chunk_repository, chunk_hash), "rb") as fsrc:
+                        fdst.write(zlib.decompress(fsrc.read()))
+            restored += 1
+        except:
+            log("Error restoring " + entry[1], "Warning", version)
+    chunk_db_conn.close()
+    return restored
+
+
+# Print catalog entries, one line per version of each file
+def print_entries(entries):
+    for entry in entries:
+        if entry[3] is None:
+            modified = "unknown"
+        else:
+            modified = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry[3] / 1000000000))
+        print(entry[0] + " | " + modified + " | " + str(entry[2]) + " bytes | " + str(entry[5]) + " | " + entry[1])
+
+
+# Main routine - finds or restores files using the catalog
+def main():
+    from backutil import version, Config
+    colorama.init()
+    try:
+        command = sys.argv[1]
+        arguments, values = getopt.getopt(sys.argv[2:], "n:p:d:o:", ["name=", "path=", "date=", "output="])
+    except:
+        print_usage()
+        sys.exit()
+
+    # Server folder, password and backup name come from config.ini, as for backups
+    try:
+        config_file = configparser.ConfigParser()
+        config_file.read('config.ini')
+        config = Config(str(config_file['LOCAL']['computer_name']), "", "", str(config_file['LOCAL']['archive_pass']), str(config_file['SERVER']['server_directory']), "False", 0, 0, "False", 1)
+        config.chunk_repository = str(config_file['LOCAL'].get('chunk_repository', config.chunk_repository))
+    except:
+        log("Error loading configuration.", "Failure", version)
+        sys.exit()
+    prefix = ""
+    backup_date = ""
+    output_folder = ""
+    for current_argument, current_value in arguments:
+        if current_argument in ("-n", "--name"):
+            config.computer_name = current_value
+            config.previous_db_name = current_value + ".sqlite"
+        if current_argument in ("-p", "--path"):
+            prefix = current_value
+        if current_argument in ("-d", "--date"):
+            backup_date = current_value
+        if current_argument in ("-o", "--output"):
+            output_folder = current_value
+    if command not in ("find", "restore") or prefix == "" or (command == "restore" and output_folder == ""):
+        print_usage()
+        sys.exit()
+
+    manage_previous_db(config, "open", version)
+    start = time.perf_counter()
+    if command == "find" and backup_date == "":
+        entries = find_entries(config, prefix, None)
+    else:
+        entries = find_entries(config, prefix, get_catalog_date(config, backup_date))
+    log("Found " + str(len(entries)) + " catalog entries in " + str(round((time.perf_counter() - start) * 1000, 1)) + " ms.", "Success", version)
+    manage_previous_db(config, "close", version)
+    if command == "find":
+        print_entries(entries)
+    else:
+        restored = restore_entries(config, entries, output_folder, version)
+        log("Restored " + str(restored) + " of " + str(len(entries)) + " files.", "Success", version)
+
+
+if __name__ == "__main__":
+    main()
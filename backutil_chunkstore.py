@@ -0,0 +1,296 @@
+import os, sys, getopt, sqlite3, hashlib, zlib, colorama
+from backutil_subfuncs import log, hash_algorithms, throttle
+
+# Optional vectorised chunk boundary search, only used when numpy is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+chunk_min_size = 524288
+chunk_avg_size = 1048576
+chunk_max_size = 8388608
+chunk_read_size = 16777216
+chunk_scan_size = 1048576
+
+# Gear table for the rolling hash - derived from SHA-256 so chunk boundaries never change between versions
+chunk_gear = [int.from_bytes(hashlib.sha256(bytes([x])).digest()[:8], "little") for x in range(256)]
+
+# Normalised chunking - a stricter mask before the average size and a looser one after it
+chunk_mask_s = ((1 << 22) - 1) << 42
+chunk_mask_l = ((1 << 18) - 1) << 46
+if numpy is not None:
+    chunk_gear_array = numpy.array(chunk_gear, dtype=numpy.uint64)
+
+
+# Print chunk store usage
+def print_usage():
+    print("")
+    print("Usage: backutil_chunkstore.py restore [options]")
+    print("")
+    print("OPTIONS")
+    print("--repo <dir>     | -r <dir>    | Sets chunk repository folder")
+    print("--date <date>    | -d <date>   | Sets backup to restore (default latest)")
+    print("--output <dir>   | -o <dir>    | Sets folder to restore files into")
+    print("--prefix <path>  | -p <path>   | Only restores files under this path")
+    print("")
+
+
+# Find the end of the next chunk in data, starting from offset, using a gear rolling hash
+def find_chunk_boundary(data, offset, final):
+    remaining = len(data) - offset
+    if remaining <= chunk_min_size:
+        return len(data) if final else -1
+    end = min(len(data), offset + chunk_max_size)
+    normal = min(end, offset + chunk_avg_size)
+    gear = chunk_gear
+    h = 0
+
+    # The first chunk_min_size bytes of each chunk can never hold a boundary, so are skipped
+    for x in range(offset + chunk_min_size, normal):
+        h = ((h << 1) + gear[data[x]]) & 0xFFFFFFFFFFFFFFFF
+        if not h & chunk_mask_s:
+            return x + 1
+    for x in range(normal, end):
+        h = ((h << 1) + gear[data[x]]) & 0xFFFFFFFFFFFFFFFF
+        if not h & chunk_mask_l:
+            return x + 1
+    if end == offset + chunk_max_size or final:
+        return end
+    return -1
+
+
+# Get the gear hash at each position from block_start to block_end, as find_chunk_boundary would compute it
+def get_gear_hashes(data, start, block_start, block_end):
+    # The hash only holds 64 bits, so each position depends on at most the 64 bytes ending there
+    window_start = max(start, block_start - 63)
+    hashes = chunk_gear_array[numpy.frombuffer(data, dtype=numpy.uint8, count=block_end - window_start, offset=window_start)]
+    
+    # Sum each position's shifted gear values over windows of 1, 2, 4 ... 64 bytes
+    shift = 1
+    while shift < 64:
+        hashes[shift:] += hashes[:-shift] << numpy.uint64(shift)
+        shift *= 2
+    return hashes[block_start - window_start:]
+
+
+# Find the same chunk boundary as find_chunk_boundary, checking a block of positions at a time with numpy
+def find_chunk_boundary_vectorised(data, offset, final):
+    remaining = len(data) - offset
+    if remaining <= chunk_min_size:
+        return len(data) if final else -1
+    end = min(len(data), offset + chunk_max_size)
+    normal = min(end, offset + chunk_avg_size)
+    start = offset + chunk_min_size
+    block_start = start
+    while block_start < end:
+        if block_start < normal:
+            block_end = min(normal, block_start + chunk_scan_size)
+            mask = numpy.uint64(chunk_mask_s)
+        else:
+            block_end = min(end, block_start + chunk_scan_size)
+            mask = numpy.uint64(chunk_mask_l)
+        matches = numpy.flatnonzero((get_gear_hashes(data, start, block_start, block_end) & mask) == 0)
+        if len(matches) > 0:
+            return block_start + int(matches[0]) + 1
+        block_start = block_end
+    if end == offset + chunk_max_size or final:
+        return end
+    return -1
+
+
+# Split a file into content-defined chunks, yielding each chunk's bytes
+def split_chunks(f):
+    if numpy is not None:
+        find_boundary = find_chunk_boundary_vectorised
+    else:
+        find_boundary = find_chunk_boundary
+    data = b""
+    final = False
+    while True:
+        if not final:
+            block = f.read(chunk_read_size)
+            final = block == b""
+            data = data + block
+        offset = 0
+        while offset < len(data):
+            boundary = find_boundary(data, offset, final)
+            if boundary == -1:
+                break
+            yield data[offset:boundary]
+            offset = boundary
+        data = data[offset:]
+        if final and data == b"":
+            return
+
+
+# Get path of a chunk in the repository, fanned out by the first two hash characters
+def get_chunk_path(repository, chunk_hash):
+    return os.path.join(repository, "chunks", chunk_hash[:2], chunk_hash)
+
+
+# Chunk store DB management
+def manage_chunk_db(config, action, version):
+    # Open/create DB - one index per repository, holding chunk lists and per-run manifests
+    if action == "open":
+        log("Opening chunk store DB...", "Attempt", version)
+        os.makedirs(os.path.join(config.chunk_repository, "chunks"), exist_ok=True)
+        config.chunk_db_name = os.path.join(config.chunk_repository, "index.sqlite")
+        config.chunk_db_conn = sqlite3.connect(config.chunk_db_name)
+        config.chunk_db_cursor = config.chunk_db_conn.cursor()
+        config.chunk_db_cursor.execute("PRAGMA journal_mode=WAL;")
+        config.chunk_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_chunk_files(hash TEXT PRIMARY KEY, size INTEGER, chunks TEXT);")
+        config.chunk_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_manifest(date TEXT, file TEXT, hash TEXT);")
+        config.chunk_db_cursor.execute("CREATE INDEX IF NOT EXISTS backutil_manifest_date ON backutil_manifest(date);")
+        config.chunk_db_conn.commit()
+        log("Chunk store DB opened successfully.", "Success", version)
+    # Close DB
+    if action == "close":
+        log("Closing chunk store DB...", "Attempt", version)
+        config.chunk_db_conn.close()
+        log("Chunk store DB closed successfully.", "Success", version)
+
+
+# Split files into chunks and write any chunks not already in the repository
+def store_chunks(procnum, files_to_back_up_process, repository, hash_algorithm, version):
+    colorama.init()
+    new_hash = hash_algorithms[hash_algorithm]
+    return_dict_process = {}
+    for backup_file in files_to_back_up_process:
+        try:
+            chunk_hashes = []
+            file_size = 0
+            bytes_written = 0
+            file_hash = new_hash()
+            throttle("iops", 1)
+            with open(backup_file[0], "rb") as f:
+                for chunk in split_chunks(f):
+                    throttle("read", len(chunk))
+                    file_hash.update(chunk)
+                    file_size += len(chunk)
+                    chunk_hash = hashlib.sha256(chunk).hexdigest()
+                    chunk_hashes.append(chunk_hash)
+                    chunk_path = get_chunk_path(repository, chunk_hash)
+                    if os.path.exists(chunk_path):
+                        continue
+
+                    # Chunks are written under a temporary name so a partial chunk is never seen as stored
+                    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                    compressed = zlib.compress(chunk, 1)
+                    throttle("write", len(compressed))
+                    temp_path = chunk_path + "." + str(os.getpid()) + ".tmp"
+                    with open(temp_path, "wb") as fdst:
+                        fdst.write(compressed)
+                    os.replace(temp_path, chunk_path)
+                    bytes_written += len(compressed)
+
+            # A file that changed since it was hashed is left for the next run
+            if file_hash.hexdigest() != backup_file[1]:
+                msg = "File changed during backup, skipped " + backup_file[0]
+                log(msg, "Warning", version)
+                continue
+            return_dict_process[backup_file[1]] = (file_size, ",".join(chunk_hashes), bytes_written)
+        except:
+            error = "Error storing chunks for " + os.path.basename(backup_file[0])
+            log(error, "Warning", version)
+    return return_dict_process
+
+
+# Delete manifests beyond retention, then any chunk lists and chunks they no longer reference
+def prune_chunk_store(config, version):
+    log("Pruning chunk store in line with rotation configuration...", "Attempt", version)
+    manage_chunk_db(config, "open", version)
+    backup_dates = []
+    for row in config.chunk_db_cursor.execute("SELECT DISTINCT date FROM backutil_manifest ORDER BY date DESC;"):
+        backup_dates.append(row[0])
+    if len(backup_dates) > config.backups_retained:
+        query_data = (backup_dates[config.backups_retained],)
+        config.chunk_db_cursor.execute("DELETE FROM backutil_manifest WHERE date <= ?;", query_data)
+        config.chunk_db_cursor.execute("DELETE FROM backutil_chunk_files WHERE hash NOT IN (SELECT hash FROM backutil_manifest);")
+        config.chunk_db_conn.commit()
+
+        # Remove chunk files no longer listed by any stored file
+        referenced_chunks = set()
+        for row in config.chunk_db_cursor.execute("SELECT chunks FROM backutil_chunk_files;"):
+            referenced_chunks.update(row[0].split(","))
+        removed = 0
+        for root, directories, filenames in os.walk(os.path.join(config.chunk_repository, "chunks")):
+            for filename in filenames:
+                if filename not in referenced_chunks:
+                    os.remove(os.path.join(root, filename))
+                    removed += 1
+        log("Chunk store pruned (" + str(removed) + " chunks removed).", "Success", version)
+    else:
+        log("No chunk store pruning required.", "Success", version)
+    manage_chunk_db(config, "close", version)
+
+
+# Restore files recorded in a backup run's manifest by reassembling their chunks
+def restore_manifest(config, backup_date, output_folder, prefix, version):
+    log("Restoring files from chunk store...", "Attempt", version)
+    manage_chunk_db(config, "open", version)
+    if backup_date == "":
+        backup_date = config.chunk_db_cursor.execute("SELECT MAX(date) FROM backutil_manifest;").fetchone()[0]
+    
+    # A range lookup, as for the catalog, so _ and % in the prefix are not wildcards
+    from backutil_catalog import catalog_prefix_end
+    if prefix != "":
+        trailing_separator = prefix.endswith((os.sep, os.altsep or os.sep))
+        prefix = os.path.normpath(prefix)
+        if trailing_separator and not prefix.endswith(os.sep):
+            prefix = prefix + os.sep
+    query_data = (backup_date, prefix, prefix + catalog_prefix_end,)
+    rows = config.chunk_db_cursor.execute("SELECT backutil_manifest.file, backutil_chunk_files.chunks FROM backutil_manifest JOIN backutil_chunk_files ON backutil_manifest.hash = backutil_chunk_files.hash WHERE backutil_manifest.date = ? AND backutil_manifest.file >= ? AND backutil_manifest.file < ?;", query_data).fetchall()
+    restored = 0
+    for filename, chunks in rows:
+        drive, path = os.path.splitdrive(filename)
+        drive = drive.replace(":", "").replace("\\", "/").strip("/")
+        path = path.replace("\\", "/").lstrip("/")
+        destination = os.path.join(output_folder, drive, path)
+        try:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, "wb") as fdst:
+                for chunk_hash in chunks.split(","):
+                    if chunk_hash == "":
+                        continue
+                    with open(get_chunk_path(config.chunk_repository, chunk_hash), "rb") as fsrc:
+                        fdst.write(zlib.decompress(fsrc.read()))
+            restored += 1
+        except:
+            error = "Error restoring " + filename
+            log(error, "Warning", version)
+    manage_chunk_db(config, "close", version)
+    log("Restored " + str(restored) + " of " + str(len(rows)) + " files from " + str(backup_date) + ".", "Success", version)
+
+
+# Main routine - restores a backup run from the chunk store
+def main():
+    from backutil import version, Config
+    colorama.init()
+    try:
+        command = sys.argv[1]
+        arguments, values = getopt.getopt(sys.argv[2:], "r:d:o:p:", ["repo=", "date=", "output=", "prefix="])
+    except:
+        print_usage()
+        sys.exit()
+    config = Config("", "", "", "", "", "False", 0, 0, "False", 1)
+    backup_date = ""
+    output_folder = ""
+    prefix = ""
+    for current_argument, current_value in arguments:
+        if current_argument in ("-r", "--repo"):
+            config.chunk_repository = current_value
+        if current_argument in ("-d", "--date"):
+            backup_date = current_value
+        if current_argument in ("-o", "--output"):
+            output_folder = current_value
+        if current_argument in ("-p", "--prefix"):
+            prefix = current_value
+    if command != "restore" or config.chunk_repository == "" or output_folder == "":
+        print_usage()
+        sys.exit()
+    restore_manifest(config, backup_date, output_folder, prefix, version)
+
+
+if __name__ == "__main__":
+    main()
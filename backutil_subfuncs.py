@@ -1,6 +1,23 @@
-import time, sqlite3, hashlib, os, subprocess, colorama
+import time, sqlite3, hashlib, os, subprocess, shutil, fnmatch, concurrent.futures, threading, multiprocessing, atexit, json, zlib, ctypes, queue, colorama
 from termcolor import colored
 
+# Optional faster hash algorithms, only offered when their module is installed
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+previous_db_schema = 4
+hash_algorithms = {"sha256": hashlib.sha256, "blake2b": hashlib.blake2b}
+if blake3 is not None:
+    hash_algorithms["blake3"] = blake3.blake3
+if xxhash is not None:
+    hash_algorithms["xxh3"] = xxhash.xxh3_128
+
 
 # Print into header
 def print_header(header_type, version):
@@ -29,18 +46,103 @@ def print_header(header_type, version):
         print("--incremental | -i        | Turns on incremental backups")
         print("--rotate <no> | -r <no>   | Sets no. of backups to rotate")
         print("--threads <no>| -t <no>   | Sets max no. of threads")
+        print("--verify      | -v        | Re-hashes files, ignoring cache")
+        print("--copy-engine | -c <name> | Sets copy engine (robocopy/native)")
+        print("--pipeline    | -p        | Hashes and stages files in one read")
+        print("--archive-mode| -a <name> | Sets archive mode (staged/stream/chunks)")
+        print("--hash <name> | -H <name> | Sets hash algorithm (sha256/blake2b/...)")
+        print("--quiet       | -q        | Only logs warnings and failures")
+        print("--profile     | -P <file> | Saves cProfile stats for the run")
+        print("--resume      | -R        | Continues an interrupted backup")
+        print("--volumes <no>| -V <no>   | Sets no. of archive volumes built at once")
+        print("--compression | -z <name> | Sets compression profile (store/fast/normal/max)")
+        print("--throttle    | -T <MB/s> | Caps read and write speed (MB/s)")
+        print("--full-scan   | -F        | Scans every file, ignoring the watcher")
+        print("--multi       | -m <list> | Backs up profiles from config.ini (comma-separated/all)")
         print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
         print("")
 
 
-# Add entries to log CSV when required
+# Shared log writer state - one buffered file per process, with worker processes sending records over a queue
+class LogState:
+    def __init__(self):
+        self.level = 0
+        self.log_format = "csv"
+        self.log_file = None
+        self.last_flush = 0
+        self.lock = threading.Lock()
+        self.queue = None
+        self.listener = None
+        self.inherited_files = []
+
+
+log_levels = ("Attempt", "Success", "Warning", "Failure")
+log_formats = ("csv", "jsonl")
+log_flush_interval = 1
+checkpoint_interval = 5
+compressed_extensions = (".7z", ".zip", ".rar", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".cab", ".jar", ".docx", ".xlsx", ".pptx", ".odt", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".m4a", ".aac", ".ogg", ".flac", ".mp4", ".m4v", ".mkv", ".avi", ".mov", ".wmv", ".webm")
+compression_sample_size = 65536
+compression_sample_min = 1048576
+log_state = LogState()
+
+
+# Shared throttle state - token buckets in shared memory, so every worker process draws on the same limits
+class ThrottleState:
+    def __init__(self):
+        self.buckets = None
+        self.nice = "False"
+        self.schedule = []
+        self.schedule_thread = None
+        self.schedule_stop = threading.Event()
+
+
+throttle_resources = ("read", "write", "iops")
+throttle_slice = 1048576
+throttle_schedule_interval = 30
+throttle_state = ThrottleState()
+
+
+# Set log verbosity and file format - records below the level are neither printed nor written
+def configure_logging(level, log_format):
+    if level not in log_levels:
+        raise ValueError("Unknown log level: " + level)
+    if log_format not in log_formats:
+        raise ValueError("Unknown log format: " + log_format)
+    with log_state.lock:
+        log_state.level = log_levels.index(level)
+        if log_format != log_state.log_format and log_state.log_file is not None:
+            log_state.log_file.close()
+            log_state.log_file = None
+        log_state.log_format = log_format
+
+
+# Add entries to log when required - queued to the main process from workers, buffered otherwise
 def log(event_msg, event_cat, version):
-    log_file = open('backutil_log.csv', 'a')
-    current_time = time.localtime()
-    event_date = time.strftime('%Y-%m-%d', current_time)
-    event_time = time.strftime('%H:%M:%S', current_time)
-    event = event_date + "," + event_time + "," + version + "," + event_cat + "," + event_msg + "\n"
-    log_file.write(event)
+    if log_levels.index(event_cat) < log_state.level:
+        return
+    event_date, event_time = time.strftime('%Y-%m-%d %H:%M:%S').split(" ")
+    record = (event_date, event_time, version, event_cat, event_msg)
+    if log_state.queue is not None and log_state.listener is None:
+        log_state.queue.put(record)
+    else:
+        write_log_record(record)
+
+
+# Write a log record to the buffered log file and terminal, flushing at most once per interval
+def write_log_record(record):
+    event_date, event_time, version, event_cat, event_msg = record
+    with log_state.lock:
+        if log_state.log_file is None:
+            log_state.log_file = open("backutil_log." + log_state.log_format, "a", buffering=65536)
+            log_state.last_flush = time.monotonic()
+        if log_state.log_format == "jsonl":
+            event = json.dumps({"date": event_date, "time": event_time, "version": version, "category": event_cat, "message": event_msg}) + "\n"
+        else:
+            event = event_date + "," + event_time + "," + version + "," + event_cat + "," + event_msg + "\n"
+        log_state.log_file.write(event)
+        if event_cat == "Failure" or time.monotonic() - log_state.last_flush >= log_flush_interval:
+            log_state.log_file.flush()
+            log_state.last_flush = time.monotonic()
     if event_cat == "Attempt":
         print("[" + event_date + " " + event_time + "] [ATTEMPT] " + event_msg)
     elif event_cat == "Success":
@@ -49,7 +151,196 @@ def log(event_msg, event_cat, version):
         print("[" + event_date + " " + event_time + "] [" + colored("WARNING", "grey", "on_yellow") + "] " + event_msg)
     elif event_cat == "Failure":
         print("[" + event_date + " " + event_time + "] [" + colored("FAILURE", "white", "on_red") + "] " + event_msg)
-    log_file.close()
+
+
+# Flush buffered log records once the flush interval has passed, so a quiet spell never holds the last records back
+def flush_log():
+    with log_state.lock:
+        if log_state.log_file is not None and time.monotonic() - log_state.last_flush >= log_flush_interval:
+            log_state.log_file.flush()
+            log_state.last_flush = time.monotonic()
+
+
+# Write records sent by worker processes until the stop marker arrives, flushing whenever none arrive for a while
+def log_listener():
+    while True:
+        try:
+            record = log_state.queue.get(timeout=log_flush_interval)
+        except queue.Empty:
+            flush_log()
+            continue
+        if record is None:
+            break
+        write_log_record(record)
+
+
+# Get the queue worker processes send log records to, starting the listener thread on first use
+def get_log_queue():
+    if log_state.listener is None:
+        log_state.queue = multiprocessing.Queue()
+        log_state.listener = threading.Thread(target=log_listener, daemon=True)
+        log_state.listener.start()
+    return log_state.queue
+
+
+# Worker process initializer - send log records to the main process rather than writing them
+def init_worker_logging(queue, level):
+    colorama.init()
+    
+    # A forked worker inherits the parent's log file buffer, which must never be flushed from here
+    if log_state.log_file is not None:
+        log_state.inherited_files.append(log_state.log_file)
+    log_state.log_file = None
+    log_state.listener = None
+    log_state.queue = queue
+    log_state.level = level
+
+
+# Stop the listener thread and flush and close the log file
+def stop_logging():
+    if log_state.listener is not None:
+        log_state.queue.put(None)
+        log_state.listener.join()
+        log_state.listener = None
+        log_state.queue = None
+    with log_state.lock:
+        if log_state.log_file is not None:
+            log_state.log_file.close()
+            log_state.log_file = None
+
+
+atexit.register(stop_logging)
+
+
+# Set up throttling - rates are in MB/s (files per second for IOPS), with 0 meaning unlimited
+def configure_throttle(read_rate, write_rate, iops, nice, schedule):
+    throttle_state.nice = nice
+    throttle_state.schedule = parse_throttle_schedule(schedule)
+    if read_rate == 0 and write_rate == 0 and iops == 0 and throttle_state.schedule == []:
+        throttle_state.buckets = None
+        return
+    
+    # Each resource has a rate, a token count and the time tokens were last added
+    throttle_state.buckets = multiprocessing.Array("d", len(throttle_resources) * 3)
+    set_throttle_rates(read_rate, write_rate, iops)
+
+
+# Change throttle rates while workers are running
+def set_throttle_rates(read_rate, write_rate, iops):
+    rates = (read_rate * 1048576, write_rate * 1048576, iops)
+    with throttle_state.buckets.get_lock():
+        for x, rate in enumerate(rates):
+            throttle_state.buckets[x * 3] = rate
+            throttle_state.buckets[x * 3 + 1] = min(throttle_state.buckets[x * 3 + 1], rate)
+            throttle_state.buckets[x * 3 + 2] = time.monotonic()
+
+
+# Parse a time of day schedule such as "08:00=20,18:00=0" into sorted (minute of day, MB/s) pairs
+def parse_throttle_schedule(schedule):
+    entries = []
+    for entry in schedule.split(","):
+        if entry.strip() == "":
+            continue
+        start, rate = entry.split("=")
+        hours, minutes = start.strip().split(":")
+        entries.append((int(hours) * 60 + int(minutes), float(rate)))
+    return sorted(entries)
+
+
+# Get the scheduled MB/s cap at a time of day - the latest entry started, wrapping round from the previous day
+def get_scheduled_rate(schedule, current_time):
+    minute = current_time.tm_hour * 60 + current_time.tm_min
+    rate = schedule[-1][1]
+    for start, entry_rate in schedule:
+        if start <= minute:
+            rate = entry_rate
+    return rate
+
+
+# Raise or lower the read/write cap in line with the schedule until stopped
+def throttle_scheduler(iops, version):
+    current_rate = None
+    while True:
+        rate = get_scheduled_rate(throttle_state.schedule, time.localtime())
+        if rate != current_rate:
+            set_throttle_rates(rate, rate, iops)
+            current_rate = rate
+            if rate == 0:
+                log("Throttle lifted by schedule.", "Success", version)
+            else:
+                log("Throttle set to " + str(rate) + " MB/s by schedule.", "Success", version)
+        if throttle_state.schedule_stop.wait(throttle_schedule_interval):
+            break
+
+
+# Start the schedule thread if a throttle schedule is set
+def start_throttle_schedule(iops, version):
+    if throttle_state.schedule != [] and throttle_state.schedule_thread is None:
+        throttle_state.schedule_stop.clear()
+        throttle_state.schedule_thread = threading.Thread(target=throttle_scheduler, args=(iops, version,), daemon=True)
+        throttle_state.schedule_thread.start()
+
+
+# Stop the schedule thread
+def stop_throttle_schedule():
+    if throttle_state.schedule_thread is not None:
+        throttle_state.schedule_stop.set()
+        throttle_state.schedule_thread.join()
+        throttle_state.schedule_thread = None
+
+
+# Take tokens from a shared bucket, sleeping off any shortfall - tokens can go negative, so large reads wait their share
+def throttle(resource, amount):
+    buckets = throttle_state.buckets
+    if buckets is None:
+        return
+    x = throttle_resources.index(resource) * 3
+    with buckets.get_lock():
+        rate = buckets[x]
+        if rate == 0:
+            return
+        now = time.monotonic()
+        tokens = min(buckets[x + 1] + (now - buckets[x + 2]) * rate, rate)
+        tokens -= amount
+        buckets[x + 1] = tokens
+        buckets[x + 2] = now
+    if tokens < 0:
+        time.sleep(-tokens / rate)
+
+
+# Lower CPU and IO priority of the current process
+def lower_priority():
+    if hasattr(os, "nice"):
+        os.nice(10)
+        if shutil.which("ionice") is not None:
+            subprocess.call(["ionice", "-c", "3", "-p", str(os.getpid())], stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    else:
+        # Background mode lowers CPU, IO and memory priority on Windows
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), 0x00100000)
+
+
+# Get a shell command and creation flags that start an external program (such as 7z) at low CPU and IO priority when throttle_nice is on
+def get_low_priority_command(command):
+    if throttle_state.nice != "True":
+        return command, 0
+    if hasattr(os, "nice"):
+        command = "nice -n 10 " + command
+        if shutil.which("ionice") is not None:
+            command = "ionice -c 3 " + command
+        return command, 0
+    return command, subprocess.BELOW_NORMAL_PRIORITY_CLASS
+
+
+# Worker process initializer - sets up logging, throttling and priority for each worker
+def init_worker(queue, level, buckets, nice):
+    init_worker_logging(queue, level)
+    throttle_state.buckets = buckets
+    if nice == "True":
+        try:
+            lower_priority()
+        except:
+            log("Couldn't lower worker priority.", "Warning", "")
     
     
 # Previous hashes DB management
@@ -59,7 +350,9 @@ def manage_previous_db(config, action, version):
         log("Opening previous backups DB...", "Attempt", version)
         config.previous_db_conn = sqlite3.connect(config.previous_db_name)
         config.previous_db_cursor = config.previous_db_conn.cursor()
+        config.previous_db_cursor.execute("PRAGMA journal_mode=WAL;")
         config.previous_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_previous(date TEXT, hash TEXT);")
+        migrate_previous_db(config, version)
         log("Previous backups DB opened successfully.", "Success", version)
     # Close DB
     if action == "close":
@@ -67,43 +360,356 @@ def manage_previous_db(config, action, version):
         config.previous_db_conn.close()
         log("Previous backups DB closed successfully.", "Success", version)
 
+
+
+# Bring previous backups DB schema up to date, tracked with SQLite's user_version
+def migrate_previous_db(config, version):
+    schema_version = config.previous_db_cursor.execute("PRAGMA user_version;").fetchone()[0]
+    if schema_version >= previous_db_schema:
+        return
+    log("Migrating previous backups DB to schema v" + str(previous_db_schema) + "...", "Attempt", version)
+    
+    # v1 - indexes for the incremental diff and for deleting old backup dates
+    if schema_version < 1:
+        config.previous_db_cursor.execute("CREATE INDEX IF NOT EXISTS backutil_previous_hash ON backutil_previous(hash);")
+        config.previous_db_cursor.execute("CREATE INDEX IF NOT EXISTS backutil_previous_date ON backutil_previous(date);")
+    
+    # v2 - hash algorithm per row, so incremental diffs never compare hashes from different algorithms
+    if schema_version < 2:
+        config.previous_db_cursor.execute("ALTER TABLE backutil_previous ADD COLUMN algorithm TEXT NOT NULL DEFAULT 'sha256';")
+    
+    # v3 - catalog of every file in each backup and the archive holding it, for restores
+    if schema_version < 3:
+        config.previous_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_catalog(date TEXT, file TEXT, size INTEGER, mtime INTEGER, hash TEXT, algorithm TEXT, archive TEXT, member TEXT);")
+        config.previous_db_cursor.execute("CREATE INDEX IF NOT EXISTS backutil_catalog_file ON backutil_catalog(file, date);")
+        config.previous_db_cursor.execute("CREATE INDEX IF NOT EXISTS backutil_catalog_hash ON backutil_catalog(hash);")
+        config.previous_db_cursor.execute("CREATE INDEX IF NOT EXISTS backutil_catalog_date ON backutil_catalog(date, file);")
+    
+    # v4 - normalised paths plus a lookup key, so a path matches however its separators (or on Windows, its case) are written
+    if schema_version < 4:
+        config.previous_db_conn.create_function("backutil_normpath", 1, os.path.normpath)
+        config.previous_db_conn.create_function("backutil_catalog_key", 1, get_catalog_key)
+        config.previous_db_cursor.execute("ALTER TABLE backutil_catalog ADD COLUMN file_key TEXT;")
+        config.previous_db_cursor.execute("UPDATE backutil_catalog SET file = backutil_normpath(file), file_key = backutil_catalog_key(file);")
+        config.previous_db_cursor.execute("DROP INDEX IF EXISTS backutil_catalog_file;")
+        config.previous_db_cursor.execute("CREATE INDEX IF NOT EXISTS backutil_catalog_key ON backutil_catalog(file_key, date);")
+    config.previous_db_cursor.execute("PRAGMA user_version = " + str(previous_db_schema) + ";")
+    config.previous_db_conn.commit()
+    log("Previous backups DB migrated successfully.", "Success", version)
+
         
 # Tracker DB management
 def manage_tracker_db(config, action, version):
-    # Open/create DB
+    # Open/create DB - kept on disk as the session's checkpoint journal when checkpointing is on
     if action == "open":
         log("Opening tracker DB...", "Attempt", version)
-        config.tracker_db_conn = sqlite3.connect(config.tracker_db_name)
+        if config.checkpoint == "True":
+            os.makedirs(config.staging_folder, exist_ok=True)
+            config.tracker_db_name = config.staging_folder + config.computer_name + "_journal.sqlite"
+            if config.resume != "True" and os.path.exists(config.tracker_db_name):
+                log("Discarding checkpoint journal from an interrupted backup.", "Warning", version)
+                discard_session(config)
+                remove_journal(config)
+        # Profiles of a multi-profile run are opened here and archived in a worker thread, one thread at a time
+        config.tracker_db_conn = sqlite3.connect(config.tracker_db_name, check_same_thread=False)
         config.tracker_db_cursor = config.tracker_db_conn.cursor()
-        config.tracker_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_tracker(file TEXT, hash TEXT);")
+        config.tracker_db_cursor.execute("PRAGMA journal_mode=WAL;")
+        config.tracker_db_cursor.execute("PRAGMA synchronous=NORMAL;")
+        config.tracker_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_tracker(file TEXT, hash TEXT, hashed INTEGER);")
+        config.tracker_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_session(key TEXT PRIMARY KEY, value TEXT);")
+        config.tracker_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_journal(file TEXT PRIMARY KEY, state TEXT, archive TEXT);")
+        config.tracker_db_conn.commit()
         log("Tracker DB opened successfully.", "Success", version)
-    # Close DB
+    # Close DB - the journal is only removed once the session has completed
     if action == "close":
         log("Closing tracker DB...", "Attempt", version)
-        config.previous_db_conn.close()
+        config.tracker_db_conn.close()
+        if config.checkpoint == "True" and config.session_state == "complete":
+            remove_journal(config)
         log("Tracker DB closed successfully.", "Success", version)
 
+
+# Remove an interrupted session's folder and archive list files, found from the journal it left behind
+def discard_session(config):
+    try:
+        journal_conn = sqlite3.connect(config.tracker_db_name)
+        row = journal_conn.execute("SELECT value FROM backutil_session WHERE key = 'backup_time';").fetchone()
+        journal_conn.close()
+    except:
+        return
+    if row is None or row[0] == "":
+        return
+    backup_time = row[0]
+    shutil.rmtree(config.staging_folder + backup_time, ignore_errors=True)
+    for filename in os.listdir(config.staging_folder):
+        if filename.startswith(backup_time + ".") and filename.endswith(".txt"):
+            try:
+                os.remove(config.staging_folder + filename)
+            except OSError:
+                pass
+
+
+# Remove a session's checkpoint journal, including its WAL files
+def remove_journal(config):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(config.tracker_db_name + suffix)
+        except OSError:
+            pass
+
+
+# Load an interrupted session's settings from the checkpoint journal, so it continues as it started
+def load_session(config, version):
+    session = dict(config.tracker_db_cursor.execute("SELECT key, value FROM backutil_session;").fetchall())
+    if session.get("backup_time", "") == "":
+        log("No interrupted session found, starting a new backup.", "Warning", version)
+        config.resume = "False"
+        config.tracker_db_cursor.execute("DELETE FROM backutil_tracker;")
+        config.tracker_db_cursor.execute("DELETE FROM backutil_journal;")
+        return
+    config.backup_time = session["backup_time"]
+    config.session_state = session.get("state", "")
+    config.archive_mode = session.get("archive_mode", config.archive_mode)
+    config.copy_engine = session.get("copy_engine", config.copy_engine)
+    config.pipeline = session.get("pipeline", config.pipeline)
+    config.hash_algorithm = session.get("hash_algorithm", config.hash_algorithm)
+    config.partial_scan = session.get("partial_scan", config.partial_scan)
+    config.scan_time = float(session.get("scan_time", config.scan_time))
+    log("Resuming session " + config.backup_time + " (last checkpoint: " + config.session_state + ").", "Success", version)
+
+
+# Save the session's settings and progress to the checkpoint journal
+def save_session(config, state):
+    config.session_state = state
+    query_data = (("backup_time", config.backup_time), ("state", state), ("archive_mode", config.archive_mode), ("copy_engine", config.copy_engine), ("pipeline", config.pipeline), ("hash_algorithm", config.hash_algorithm), ("partial_scan", config.partial_scan), ("scan_time", str(config.scan_time)),)
+    config.tracker_db_cursor.executemany("INSERT OR REPLACE INTO backutil_session (key, value) VALUES (?, ?);", query_data)
+    config.tracker_db_conn.commit()
+    config.last_checkpoint = time.monotonic()
+
+
+# Record each file's progress (enumerated, hashed, staged or archived) in the checkpoint journal
+def set_journal_state(config, files, state):
+    if config.checkpoint != "True":
+        return
+    query_data = ((filename, state) for filename in files)
+    config.tracker_db_cursor.executemany("INSERT OR REPLACE INTO backutil_journal (file, state) VALUES (?, ?);", query_data)
+
+
+# Get files at a given state in the checkpoint journal
+def get_journal_files(config, state):
+    query_data = (state,)
+    return [row[0] for row in config.tracker_db_cursor.execute("SELECT file FROM backutil_journal WHERE state = ?;", query_data)]
+
+
+# Commit the checkpoint journal at most once per interval while workers are running
+def checkpoint(config):
+    if config.checkpoint == "True" and time.monotonic() - config.last_checkpoint >= checkpoint_interval:
+        config.tracker_db_conn.commit()
+        config.last_checkpoint = time.monotonic()
+
+
+# Hash cache DB management
+def manage_cache_db(config, action, version):
+    # Open/create DB - shares the previous backups DB file unless set otherwise
+    if action == "open":
+        log("Opening hash cache DB...", "Attempt", version)
+        if config.cache_db_name == "":
+            config.cache_db_name = config.previous_db_name
+        config.cache_db_conn = sqlite3.connect(config.cache_db_name)
+        config.cache_db_cursor = config.cache_db_conn.cursor()
+        config.cache_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_cache(file TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, ctime INTEGER, hash TEXT);")
+        columns = [row[1] for row in config.cache_db_cursor.execute("PRAGMA table_info(backutil_cache);")]
+        if "algorithm" not in columns:
+            config.cache_db_cursor.execute("ALTER TABLE backutil_cache ADD COLUMN algorithm TEXT NOT NULL DEFAULT 'sha256';")
+        log("Hash cache DB opened successfully.", "Success", version)
+    # Close DB
+    if action == "close":
+        log("Closing hash cache DB...", "Attempt", version)
+        config.cache_db_conn.close()
+        log("Hash cache DB closed successfully.", "Success", version)
+
+
+# Get stat signature used to detect changed files
+def get_stat_signature(filename):
+    try:
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_ctime_ns)
+    except:
+        return None
+
+
+# Read folders plus include/exclude patterns from the backup list file
+def read_backup_list(backup_list_file):
+    backup_list = []
+    include_patterns = []
+    exclude_patterns = []
+    with open(backup_list_file) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.strip() == "":
+                continue
+            if line.startswith("include:"):
+                include_patterns.append(line[8:].strip().replace("\\", "/"))
+            elif line.startswith("exclude:"):
+                exclude_patterns.append(line[8:].strip().replace("\\", "/"))
+            else:
+                # Normalised so every path under the folder is written with the same separators
+                backup_list.append(os.path.normpath(line))
+    return backup_list, include_patterns, exclude_patterns
+
+
+# Check a file or folder against glob patterns - patterns containing a slash match the full path, others the name
+def match_patterns(path, name, patterns):
+    for pattern in patterns:
+        if "/" in pattern:
+            if fnmatch.fnmatch(path.replace("\\", "/"), pattern):
+                return True
+        elif fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+# Walk one backup folder with os.scandir, keeping each file's stat signature from the directory entry
+def scan_folder(folder, include_patterns, exclude_patterns, walk_cache, version):
+    backup_files = []
+    file_stats = {}
+    total_bytes = 0
+    folders = [folder]
+    while folders:
+        current_folder = folders.pop()
+        try:
+            # Profiles of a multi-profile run share folder listings, so folders in several profiles are only read once
+            if walk_cache != "" and current_folder in walk_cache:
+                entries = walk_cache[current_folder]
+            else:
+                entries = list(os.scandir(current_folder))
+                if walk_cache != "":
+                    walk_cache[current_folder] = entries
+        except OSError:
+            msg = "Couldn't read folder " + current_folder
+            log(msg, "Warning", version)
+            continue
+        for entry in entries:
+            path = os.path.join(current_folder, entry.name)
+            if match_patterns(path, entry.name, exclude_patterns):
+                continue
+            try:
+                # Like os.walk, symlinked folders are listed but not followed
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        folders.append(path)
+                    continue
+            except OSError:
+                continue
+            if include_patterns and not match_patterns(path, entry.name, include_patterns):
+                continue
+            try:
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino or entry.inode(), stat.st_ctime_ns)
+                total_bytes += stat.st_size
+            except OSError:
+                signature = None
+            backup_files.append(path)
+            file_stats[path] = signature
+    return backup_files, file_stats, total_bytes
+
+
+# Generate list of all files in the backup folders, optionally walking each folder in its own thread
+def enumerate_files(config, backup_list, include_patterns, exclude_patterns, version):
+    start = time.perf_counter()
+    backup_files = []
+    total_bytes = 0
+    if config.parallel_walk == "True" and len(backup_list) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_threads) as executor:
+            results = list(executor.map(lambda folder: scan_folder(folder, include_patterns, exclude_patterns, config.walk_cache, version), backup_list))
+    else:
+        results = [scan_folder(folder, include_patterns, exclude_patterns, config.walk_cache, version) for folder in backup_list]
+    for folder_files, folder_stats, folder_bytes in results:
+        backup_files.extend(folder_files)
+        config.file_stats.update(folder_stats)
+        total_bytes += folder_bytes
+    msg = "File list generated successfully (" + str(len(backup_files)) + " files, " + str(total_bytes // 1048576) + " MB, " + ("%.2f" % (time.perf_counter() - start)) + " s)."
+    log(msg, "Success", version)
+    return backup_files
+
+
+# Check hash cache and return cached hashes plus list of files that need hashing
+def get_cached_hashes(config, backup_files, version):
+    log("Checking hash cache...", "Attempt", version)
+    manage_cache_db(config, "open", version)
+    cached_hashes = {}
+    files_to_hash = []
+    for filename in backup_files:
+        if filename in config.file_stats:
+            signature = config.file_stats[filename]
+        else:
+            signature = get_stat_signature(filename)
+            config.file_stats[filename] = signature
+        
+        # Forced verification or unreadable stat means the file is always hashed
+        if config.verify_hashes == "True" or signature is None:
+            files_to_hash.append(filename)
+            continue
+        query_data = (filename,)
+        row = config.cache_db_cursor.execute("SELECT size, mtime, inode, ctime, hash, algorithm FROM backutil_cache WHERE file = ?;", query_data).fetchone()
+        if row is not None and tuple(row[:4]) == signature and row[5] == config.hash_algorithm:
+            cached_hashes[filename] = row[4]
+        else:
+            files_to_hash.append(filename)
+    manage_cache_db(config, "close", version)
+    msg = "Hash cache checked (" + str(len(cached_hashes)) + " hits, " + str(len(files_to_hash)) + " misses)."
+    log(msg, "Success", version)
+    return cached_hashes, files_to_hash
+
+
+# Write newly hashed files in the tracker DB to hash cache and remove files no longer in the backup list
+def update_hash_cache(config, skip_files, version):
+    log("Updating hash cache...", "Attempt", version)
+    manage_cache_db(config, "open", version)
+    new_hashes = config.tracker_db_conn.execute("SELECT file, hash FROM backutil_tracker WHERE hashed = 1;")
+    # Files hashed before an interruption may have changed since, so their hashes don't match this run's stat signatures
+    query_data = ((filename,) + config.file_stats[filename] + (hash_output, config.hash_algorithm,) for filename, hash_output in new_hashes if config.file_stats.get(filename) is not None and filename not in skip_files)
+    config.cache_db_cursor.executemany("INSERT OR REPLACE INTO backutil_cache (file, size, mtime, inode, ctime, hash, algorithm) VALUES (?, ?, ?, ?, ?, ?, ?);", query_data)
+    
+    # A backup of only changed paths can only tell which of those paths have gone
+    stale_files = []
+    if config.partial_scan == "True":
+        for filename in config.dirty_files:
+            if filename not in config.file_stats:
+                stale_files.append((filename,))
+    else:
+        for row in config.cache_db_cursor.execute("SELECT file FROM backutil_cache;"):
+            if row[0] not in config.file_stats:
+                stale_files.append((row[0],))
+    config.cache_db_cursor.executemany("DELETE FROM backutil_cache WHERE file = ?;", stale_files)
+    config.cache_db_conn.commit()
+    manage_cache_db(config, "close", version)
+    log("Hash cache updated successfully.", "Success", version)
+
         
 # Generate hashes
-def generate_hashes(procnum, backup_files_thread, return_dict, version):
+def generate_hashes(procnum, backup_files_thread, hash_algorithm, buffer_size, version):
     colorama.init()
+    new_hash = hash_algorithms[hash_algorithm]
     return_dict_process = {}
     for filename in backup_files_thread:
         try:
-            sha256_hash = hashlib.sha256()
+            file_hash = new_hash()
+            throttle("iops", 1)
             with open(filename,"rb") as f:
-                for byte_block in iter(lambda: f.read(65535),b""):
-                    sha256_hash.update(byte_block)
-                hash_output = (sha256_hash.hexdigest())
+                for byte_block in iter(lambda: f.read(buffer_size),b""):
+                    throttle("read", len(byte_block))
+                    file_hash.update(byte_block)
+                hash_output = (file_hash.hexdigest())
                 return_dict_process[filename] = hash_output
         except:
             msg = "Couldn't generate hash for " + filename
             log(msg, "Warning", version)
-    return_dict[procnum] = return_dict_process
+    return return_dict_process
 
 
 # Copy files to staging folder
-def copy_files(procnum, files_to_back_up_process, staging_folder, backup_time, return_dict, version):
+def copy_files(procnum, files_to_back_up_process, staging_folder, backup_time, version):
     colorama.init()
     FNULL = open(os.devnull, 'w')
     return_dict_process = {}    
@@ -120,47 +726,394 @@ def copy_files(procnum, files_to_back_up_process, staging_folder, backup_time, r
             pass
         copy_command = "robocopy " + "\"" + backup_file[0].rsplit('\\', 1)[0] + "\"" + " " + "\"" + backup_path.replace("/","\\") + "\" \"" + backup_filename + "\"  /NFL /NDL /NJH /NJS /nc /ns /np"
         try:
+            throttle("iops", 1)
             output = subprocess.call(copy_command, shell=True, stdout=FNULL, stderr=subprocess.STDOUT)
             if output == 1:
                 return_dict_process[backup_file[1]] = "Y"
+                
+                # Robocopy can't be throttled as it runs, so the file's size is taken from the buckets afterwards
+                file_size = get_file_size(backup_file[0], {})
+                throttle("read", file_size)
+                throttle("write", file_size)
             else:
                 error = "Error copying " + backup_filename
                 log(error, "Warning", version)
         except:
             error = "Error copying " + backup_filename
             log(error, "Warning", version)
-    return_dict[procnum] = return_dict_process
+    return return_dict_process
 
 
-# If backups require rotation, ignore oldest hash file
-def get_prev_hashes(config, version):
-    log("Checking old backup hashes...", "Attempt", version)
+# Get staging path for a source file, using the drive letter as the top folder
+def get_staging_path(source_path, staging_folder, backup_time):
+    drive, path = os.path.splitdrive(source_path)
+    drive = drive.replace(":", "").replace("\\", "/").strip("/")
+    path = path.replace("\\", "/").lstrip("/")
+    return os.path.join(staging_folder + backup_time, drive, path)
+
+
+# Copy a single file with the fastest method available on the platform
+def copy_file_native(source, destination):
+    copied = False
+    throttle("iops", 1)
+    if hasattr(os, "copy_file_range"):
+        # Copy in slices when throttled, so each slice waits for its share of bandwidth
+        if throttle_state.buckets is None:
+            length = 1073741824
+        else:
+            length = throttle_slice
+        try:
+            with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+                while True:
+                    copied_bytes = os.copy_file_range(fsrc.fileno(), fdst.fileno(), length)
+                    if copied_bytes <= 0:
+                        break
+                    throttle("read", copied_bytes)
+                    throttle("write", copied_bytes)
+            copied = True
+        except OSError:
+            pass
+    # shutil.copyfile uses sendfile/fcopyfile where the platform supports it
+    if not copied:
+        shutil.copyfile(source, destination)
+        file_size = os.path.getsize(destination)
+        throttle("read", file_size)
+        throttle("write", file_size)
+    shutil.copystat(source, destination)
+
+
+# Copy files to staging folder in-process, without an external copy tool
+def copy_files_native(procnum, files_to_back_up_process, staging_folder, backup_time, version):
+    colorama.init()
+    return_dict_process = {}
+    created_folders = set()
+    for backup_file in files_to_back_up_process:
+        destination = get_staging_path(backup_file[0], staging_folder, backup_time)
+        folder = os.path.dirname(destination)
+        try:
+            if folder not in created_folders:
+                os.makedirs(folder, exist_ok=True)
+                created_folders.add(folder)
+            copy_file_native(backup_file[0], destination)
+            return_dict_process[backup_file[1]] = "Y"
+        except:
+            error = "Error copying " + os.path.basename(backup_file[0])
+            log(error, "Warning", version)
+    return return_dict_process
+
+
+# Generate hashes while streaming files into the staging folder in one read
+def hash_and_copy_files(procnum, backup_files_thread, staging_folder, backup_time, hash_algorithm, buffer_size, version):
+    colorama.init()
+    new_hash = hash_algorithms[hash_algorithm]
+    return_dict_process = {}
+    created_folders = set()
+    for filename in backup_files_thread:
+        destination = get_staging_path(filename, staging_folder, backup_time)
+        folder = os.path.dirname(destination)
+        try:
+            if folder not in created_folders:
+                os.makedirs(folder, exist_ok=True)
+                created_folders.add(folder)
+            file_hash = new_hash()
+            throttle("iops", 1)
+            with open(filename, "rb") as fsrc, open(destination, "wb") as fdst:
+                for byte_block in iter(lambda: fsrc.read(buffer_size), b""):
+                    throttle("read", len(byte_block))
+                    file_hash.update(byte_block)
+                    throttle("write", len(byte_block))
+                    fdst.write(byte_block)
+            shutil.copystat(filename, destination)
+            return_dict_process[filename] = file_hash.hexdigest()
+        except:
+            msg = "Couldn't generate hash for " + filename
+            log(msg, "Warning", version)
+            try:
+                os.remove(destination)
+            except:
+                pass
+    return return_dict_process
+
+
+# Remove a file staged by the pipeline, plus any folders it leaves empty
+def discard_staged_file(filename, staging_folder, backup_time):
+    session_folder = os.path.normpath(staging_folder + backup_time)
+    destination = get_staging_path(filename, staging_folder, backup_time)
+    try:
+        os.remove(destination)
+        folder = os.path.dirname(os.path.normpath(destination))
+        while folder != session_folder and folder.startswith(session_folder):
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+    except OSError:
+        pass
+
+
+# Get file size for scheduling, using the stat signature captured by the hash cache if present
+def get_file_size(filename, file_stats):
+    signature = file_stats.get(filename)
+    if signature is not None:
+        return signature[0]
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+# Split files into batches for the worker pool - large files first and alone, small files grouped
+def schedule_batches(items, sizes, max_threads, max_batch_files=256):
+    total_size = sum(sizes)
+    batch_size = max(total_size // (max_threads * 8), 1048576)
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for item, size in sorted(zip(items, sizes), key=lambda kv: kv[1], reverse=True):
+        if size >= batch_size:
+            batches.append([item])
+            continue
+        batch.append(item)
+        batch_bytes += size
+        if batch_bytes >= batch_size or len(batch) >= max_batch_files:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# Run one batch in a worker and time it, so throughput can be reported per worker
+def timed_batch(target, procnum, batch, *target_args):
+    start = time.perf_counter()
+    batch_output = target(procnum, batch, *target_args)
+    return os.getpid(), time.perf_counter() - start, batch_output
+
+
+# Total size of a list of files (or file, hash, date rows) from the stat signatures captured during enumeration
+def sum_file_sizes(files, file_stats):
+    total_bytes = 0
+    for item in files:
+        if not isinstance(item, str):
+            item = item[0]
+        total_bytes += get_file_size(item, file_stats)
+    return total_bytes
+
+
+# Record wall time, file count, bytes and per-worker throughput for a phase of the run
+def record_phase(config, phase, start, file_count, bytes_processed, workers=None):
+    seconds = time.perf_counter() - start
+    phase_metrics = {"phase": phase, "seconds": round(seconds, 3), "files": file_count, "bytes": bytes_processed, "mb_per_second": round(bytes_processed / 1048576 / seconds, 2) if seconds > 0 else 0}
+    if workers is not None:
+        phase_metrics["workers"] = []
+        for x, worker in enumerate(sorted(workers.values(), key=lambda w: w["pid"]), 1):
+            phase_metrics["workers"].append({"worker": x, "batches": worker["batches"], "seconds": round(worker["seconds"], 3), "bytes": worker["bytes"], "mb_per_second": round(worker["bytes"] / 1048576 / worker["seconds"], 2) if worker["seconds"] > 0 else 0})
+    config.metrics.append(phase_metrics)
+
+
+# Write run metrics as a JSON line appended per run and/or a Prometheus textfile collector file
+def write_metrics(config, version):
+    if config.metrics_file == "" and config.metrics_prom_file == "":
+        return
+    log("Writing run metrics...", "Attempt", version)
+    run_seconds = round(time.perf_counter() - config.run_start, 3)
+    if config.metrics_file != "":
+        summary = {"name": config.computer_name, "version": version, "backup_time": config.backup_time, "started": config.run_started, "seconds": run_seconds, "phases": config.metrics}
+        with open(config.metrics_file, "a") as f:
+            f.write(json.dumps(summary) + "\n")
+    if config.metrics_prom_file != "":
+        name = config.computer_name.replace("\\", "\\\\").replace("\"", "\\\"")
+        lines = []
+        lines.append("# HELP backutil_run_seconds Wall time of the last backup run.")
+        lines.append("# TYPE backutil_run_seconds gauge")
+        lines.append("backutil_run_seconds{name=\"" + name + "\"} " + str(run_seconds))
+        lines.append("# HELP backutil_run_timestamp_seconds Start time of the last backup run.")
+        lines.append("# TYPE backutil_run_timestamp_seconds gauge")
+        lines.append("backutil_run_timestamp_seconds{name=\"" + name + "\"} " + str(config.run_started))
+        for metric, key, help_text in (("backutil_phase_seconds", "seconds", "Wall time of each phase of the last backup run."), ("backutil_phase_files", "files", "Files processed by each phase of the last backup run."), ("backutil_phase_bytes", "bytes", "Bytes processed by each phase of the last backup run.")):
+            lines.append("# HELP " + metric + " " + help_text)
+            lines.append("# TYPE " + metric + " gauge")
+            for phase_metrics in config.metrics:
+                lines.append(metric + "{name=\"" + name + "\",phase=\"" + phase_metrics["phase"] + "\"} " + str(phase_metrics[key]))
+        lines.append("# HELP backutil_worker_mb_per_second Throughput of each worker in the last backup run.")
+        lines.append("# TYPE backutil_worker_mb_per_second gauge")
+        for phase_metrics in config.metrics:
+            for worker in phase_metrics.get("workers", []):
+                lines.append("backutil_worker_mb_per_second{name=\"" + name + "\",phase=\"" + phase_metrics["phase"] + "\",worker=\"" + str(worker["worker"]) + "\"} " + str(worker["mb_per_second"]))
+        
+        # Written under a temporary name, as the collector may read the file at any time
+        with open(config.metrics_prom_file + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(config.metrics_prom_file + ".tmp", config.metrics_prom_file)
+    log("Run metrics written successfully.", "Success", version)
+
+
+# Write the list of source files for 7-Zip to read when streaming an archive
+def write_archive_list(files_to_back_up, list_file):
+    with open(list_file, "w", encoding="utf-8") as f:
+        for backup_file in files_to_back_up:
+            f.write(backup_file[0] + "\n")
+
+
+# Check whether a file is already compressed, by extension or by how well a sample from its middle compresses
+def is_compressed_file(filename, size):
+    if os.path.splitext(filename)[1].lower() in compressed_extensions:
+        return True
+    if size < compression_sample_min:
+        return False
+    try:
+        with open(filename, "rb") as f:
+            f.seek(size // 2)
+            sample = f.read(compression_sample_size)
+    except OSError:
+        return False
+    return len(zlib.compress(sample, 1)) >= len(sample) * 0.95
+
+
+# Split files into archive volumes of similar size - largest first, each into the smallest volume so far
+def schedule_volumes(items, sizes, volume_count):
+    volumes = [[] for x in range(volume_count)]
+    volume_bytes = [0] * volume_count
+    for item, size in sorted(zip(items, sizes), key=lambda kv: kv[1], reverse=True):
+        x = volume_bytes.index(min(volume_bytes))
+        volumes[x].append(item)
+        volume_bytes[x] += size
+    return [volume for volume in volumes if volume]
+
+
+# Get the path a source file is stored under inside a .7z archive - staged archives hold the session folder, streamed ones the path without drive
+def get_archive_member(source_path, archive_mode, backup_time):
+    drive, path = os.path.splitdrive(source_path)
+    drive = drive.replace(":", "").replace("\\", "/").strip("/")
+    path = path.replace("\\", "/").lstrip("/")
+    if archive_mode == "stream":
+        return path
+    return "/".join(part for part in (backup_time, drive, path) if part != "")
+
+
+# Get the key catalog entries are looked up by - separators normalised, and case folded where the file system ignores case
+def get_catalog_key(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+# Catalog entries for an unchanged file point to the latest archive already holding its content
+catalog_insert_query = "INSERT INTO backutil_catalog (date, file, file_key, size, mtime, hash, algorithm, archive, member) SELECT ?, run.file, run.file_key, run.size, run.mtime, run.hash, ?, COALESCE(run.archive, (SELECT catalog.archive FROM backutil_catalog AS catalog WHERE catalog.hash = run.hash AND catalog.algorithm = ? AND catalog.archive IS NOT NULL ORDER BY catalog.date DESC LIMIT 1)), COALESCE(run.member, (SELECT catalog.member FROM backutil_catalog AS catalog WHERE catalog.hash = run.hash AND catalog.algorithm = ? AND catalog.archive IS NOT NULL ORDER BY catalog.date DESC LIMIT 1)) FROM temp.backutil_run AS run;"
+
+
+# Record every file in this backup in the catalog, with its size, mtime, hash and the archive holding it - committed by the caller with the backup's hashes
+def write_catalog(config, combined_dict, version):
+    log("Writing catalog...", "Attempt", version)
+    config.previous_db_cursor.execute("CREATE TEMP TABLE IF NOT EXISTS backutil_run(file TEXT, file_key TEXT, size INTEGER, mtime INTEGER, hash TEXT, archive TEXT, member TEXT);")
+    config.previous_db_cursor.execute("DELETE FROM temp.backutil_run;")
     
-    # Open DB
-    manage_previous_db(config, "open", version)
+    # Files backed up in this run are in this run's archive, the rest are looked up by hash
+    def get_rows():
+        for filename, file_hash in config.tracker_db_conn.execute("SELECT file, hash FROM backutil_tracker;"):
+            signature = config.file_stats.get(filename)
+            if signature is None:
+                signature = get_stat_signature(filename)
+            if signature is None:
+                signature = (None, None)
+            archive = None
+            member = None
+            if config.archive_mode == "chunks":
+                archive = "chunks"
+                member = filename
+            elif file_hash in combined_dict and filename in config.archive_names:
+                archive = config.archive_names[filename]
+                member = get_archive_member(filename, config.archive_mode, config.backup_time)
+            yield (os.path.normpath(filename), get_catalog_key(filename), signature[0], signature[1], file_hash, archive, member)
+    config.previous_db_cursor.executemany("INSERT INTO temp.backutil_run (file, file_key, size, mtime, hash, archive, member) VALUES (?, ?, ?, ?, ?, ?, ?);", get_rows())
+    query_data = (config.backup_time,)
+    previous_date = config.previous_db_cursor.execute("SELECT MAX(date) FROM backutil_catalog WHERE date < ?;", query_data).fetchone()[0]
+    query_data = (config.backup_time, config.hash_algorithm, config.hash_algorithm, config.hash_algorithm,)
+    config.previous_db_cursor.execute(catalog_insert_query, query_data)
+    entry_count = config.previous_db_cursor.rowcount
     
+    # A backup of only changed paths carries the rest of the last backup's entries forward
+    if config.partial_scan == "True" and previous_date is not None:
+        load_temp_files(config.previous_db_cursor, "backutil_dirty", (get_catalog_key(filename) for filename in config.dirty_files))
+        query_data = (config.backup_time, previous_date,)
+        config.previous_db_cursor.execute("INSERT INTO backutil_catalog (date, file, file_key, size, mtime, hash, algorithm, archive, member) SELECT ?, file, file_key, size, mtime, hash, algorithm, archive, member FROM backutil_catalog WHERE date = ? AND file_key NOT IN (SELECT file_key FROM temp.backutil_run) AND file_key NOT IN (SELECT file FROM temp.backutil_dirty);", query_data)
+        entry_count += config.previous_db_cursor.rowcount
+        config.previous_db_cursor.execute("DELETE FROM temp.backutil_dirty;")
+    config.previous_db_cursor.execute("DELETE FROM temp.backutil_run;")
+
+    # Only the backups still kept after rotation stay in the catalog
+    if config.backups_rotated == "True":
+        query_data = (config.backups_retained,)
+        config.previous_db_cursor.execute("DELETE FROM backutil_catalog WHERE date <= (SELECT date FROM (SELECT DISTINCT date FROM backutil_catalog ORDER BY date DESC LIMIT 1 OFFSET ?));", query_data)
+    log("Catalog written successfully (" + str(entry_count) + " entries).", "Success", version)
+    return entry_count
+
+
+# Catalog entries held by a rotated backup's archives move to the latest other archive holding the same content
+catalog_redirect_query = "UPDATE backutil_catalog SET archive = (SELECT newer.archive FROM backutil_catalog AS newer WHERE newer.hash = backutil_catalog.hash AND newer.algorithm = backutil_catalog.algorithm AND newer.archive IS NOT NULL AND newer.archive NOT LIKE ? ORDER BY newer.date DESC, newer.rowid DESC LIMIT 1), member = (SELECT newer.member FROM backutil_catalog AS newer WHERE newer.hash = backutil_catalog.hash AND newer.algorithm = backutil_catalog.algorithm AND newer.archive IS NOT NULL AND newer.archive NOT LIKE ? ORDER BY newer.date DESC, newer.rowid DESC LIMIT 1) WHERE archive LIKE ? AND EXISTS (SELECT 1 FROM backutil_catalog AS newer WHERE newer.hash = backutil_catalog.hash AND newer.algorithm = backutil_catalog.algorithm AND newer.archive IS NOT NULL AND newer.archive NOT LIKE ?);"
+
+
+# Point catalog entries held by a rotated backup at another archive with the same content, or at no archive if none has it
+def expire_catalog(config, backup_name, version):
+    log("Updating catalog entries held by rotated backup...", "Attempt", version)
+    manage_previous_db(config, "open", version)
+    archive_pattern = backup_name + ".%"
+    query_data = (archive_pattern, archive_pattern, archive_pattern, archive_pattern,)
+    config.previous_db_cursor.execute(catalog_redirect_query, query_data)
+    redirected = config.previous_db_cursor.rowcount
+    query_data = (archive_pattern,)
+    config.previous_db_cursor.execute("UPDATE backutil_catalog SET archive = NULL, member = NULL WHERE archive LIKE ?;", query_data)
+    lost = config.previous_db_cursor.rowcount
+    config.previous_db_conn.commit()
+    manage_previous_db(config, "close", version)
+    if lost > 0:
+        log(str(lost) + " catalog entries are no longer held by any archive.", "Warning", version)
+    log("Catalog entries updated successfully (" + str(redirected) + " moved to newer archives).", "Success", version)
+
+
+# Load a list of paths into a temporary table, so queries can exclude them
+def load_temp_files(cursor, table, files):
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS " + table + "(file TEXT PRIMARY KEY);")
+    cursor.execute("DELETE FROM temp." + table + ";")
+    cursor.executemany("INSERT OR IGNORE INTO temp." + table + " (file) VALUES (?);", ((filename,) for filename in files))
+
+
+# Files in the tracker DB whose hash is not in any previous backup made with the same algorithm - uses the hash index
+get_prev_hashes_query = "SELECT file, hash, 'None' AS date FROM backutil_tracker WHERE NOT EXISTS (SELECT 1 FROM backutil_previous.backutil_previous AS previous WHERE previous.hash = backutil_tracker.hash AND previous.algorithm = ?);"
+
+
+# Only runs if backups need to be rotated - deletes previous DB entries for backups beyond retention
+def expire_prev_hashes(config, version):
     # Generate list of current backups in DB
     backup_dates=[]
     db_dates = config.previous_db_cursor.execute("SELECT DISTINCT date FROM backutil_previous ORDER BY date ASC;")
     for date in db_dates:
         backup_dates.append(date[0])
     
-    # Only runs if backups need to be rotated - deletes DB entries for oldest backup
     if len(backup_dates) > (config.backups_retained - 1) and (config.backups_rotated == "True"):
-        query_data = (str(backup_dates[0]),)
-        config.previous_db_cursor.execute("DELETE FROM backutil_previous WHERE date = ?;", query_data)
+        query_data = (str(backup_dates[len(backup_dates) - (config.backups_retained - 1) - 1]),)
+        config.previous_db_cursor.execute("DELETE FROM backutil_previous WHERE date <= ?;", query_data)
         config.previous_db_conn.commit()
         log("Old backup hashes deleted.", "Success", version)
 
+
+# If backups require rotation, ignore oldest hash file
+def get_prev_hashes(config, version):
+    log("Checking old backup hashes...", "Attempt", version)
+    
+    # Open DB
+    manage_previous_db(config, "open", version)
+    
+    # Delete DB entries for backups beyond retention
+    expire_prev_hashes(config, version)
+
     # Close DB
     manage_previous_db(config, "close", version)
 
-    # JOINs previous hashes DB and tracker DB to find files to back up
+    # Anti-join of tracker DB against previous hashes DB returns only the files to back up
     query_data = (config.previous_db_name,)
     config.tracker_db_cursor.execute("ATTACH ? as backutil_previous", query_data)
-    results = config.tracker_db_cursor.execute("SELECT backutil_tracker.file, backutil_tracker.hash, backutil_previous.date FROM backutil_tracker LEFT JOIN backutil_previous ON backutil_tracker.hash=backutil_previous.hash;")
+    query_data = (config.hash_algorithm,)
+    results = config.tracker_db_cursor.execute(get_prev_hashes_query, query_data)
     for line in results:
-        if line[2] == None:
-            config.files_to_back_up.append(line)
+        config.files_to_back_up.append(line)
+    config.tracker_db_cursor.execute("DETACH backutil_previous")
     
-    log("Old backup hashes successfully checked.", "Success", version)
\ No newline at end of file
+    log("Old backup hashes successfully checked.", "Success", version)
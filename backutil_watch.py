@@ -0,0 +1,409 @@
+import os, sys, time, getopt, sqlite3, struct, select, ctypes, ctypes.util, configparser, colorama
+from backutil_subfuncs import log, flush_log, read_backup_list, match_patterns, scan_folder, get_stat_signature, manage_previous_db, expire_prev_hashes
+
+watch_flush_interval = 2
+watch_heartbeat_interval = 10
+watch_poll_interval = 60
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+inotify_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+
+# Print watcher usage
+def print_usage():
+    print("")
+    print("Usage: backutil_watch.py [options]")
+    print("")
+    print("OPTIONS")
+    print("--name <name>    | -n <name>   | Sets backup folder/record name")
+    print("--list <file>    | -l <file>   | Sets backup list file")
+    print("--source <name>  | -s <name>   | Sets change source (inotify/poll)")
+    print("")
+
+
+# Change source using Linux inotify - one watch per folder, added as folders are created
+class InotifyChangeSource:
+    def __init__(self, backup_list, exclude_patterns, version):
+        self.exclude_patterns = exclude_patterns
+        self.version = version
+        self.folders = {}
+        self.unwatched = set()
+        self.changes = []
+        self.rescan = False
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for folder in backup_list:
+            self.add_folder(folder, False)
+
+    # Watch a folder and every folder below it - files in a new folder are all changes
+    def add_folder(self, folder, new):
+        folders = [folder]
+        while folders:
+            current_folder = folders.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(current_folder), inotify_mask)
+            if wd < 0:
+                log("Couldn't watch folder " + current_folder + " (" + os.strerror(ctypes.get_errno()) + ").", "Warning", self.version)
+                self.unwatched.add(current_folder)
+                continue
+            self.folders[wd] = current_folder
+            try:
+                entries = list(os.scandir(current_folder))
+            except OSError:
+                continue
+            for entry in entries:
+                path = os.path.join(current_folder, entry.name)
+                if match_patterns(path, entry.name, self.exclude_patterns):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(path)
+                    elif new:
+                        self.changes.append(path)
+                except OSError:
+                    continue
+
+    # Try again to watch folders that couldn't be watched - returns True if any now are, as changes made meanwhile need a full scan
+    def retry_unwatched(self):
+        folders = [folder for folder in self.unwatched if os.path.isdir(folder)]
+        self.unwatched = set()
+        for folder in folders:
+            self.add_folder(folder, True)
+        return len(folders) > 0 and len(self.unwatched) < len(folders)
+
+    # Wait up to timeout seconds for changes - returns changed paths and whether a full scan is needed
+    def read_changes(self, timeout):
+        readable, writable, errors = select.select([self.fd], [], [], timeout)
+        if readable:
+            data = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, name_length = struct.unpack_from("iIII", data, offset)
+                name = os.fsdecode(data[offset + 16:offset + 16 + name_length].rstrip(b"\0"))
+                offset += 16 + name_length
+                self.handle_event(wd, mask, name)
+        changes, rescan = self.changes, self.rescan
+        self.changes = []
+        self.rescan = False
+        return changes, rescan
+
+    # Record a single inotify event
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log("Change queue overflowed, next backup will run a full scan.", "Warning", self.version)
+            self.rescan = True
+            return
+        if mask & IN_IGNORED:
+            self.folders.pop(wd, None)
+            return
+        folder = self.folders.get(wd)
+        if folder is None:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            self.rescan = True
+            return
+        path = os.path.join(folder, name)
+        if match_patterns(path, name, self.exclude_patterns):
+            return
+        if mask & IN_ISDIR:
+            # Removed or renamed folders would need every file below them listed, so fall back to a full scan
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_folder(path, True)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.rescan = True
+            return
+        self.changes.append(path)
+
+    # Stop watching
+    def close(self):
+        os.close(self.fd)
+
+
+# Change source that compares stat signatures at an interval - for platforms without inotify
+class PollChangeSource:
+    def __init__(self, backup_list, exclude_patterns, version):
+        self.backup_list = backup_list
+        self.exclude_patterns = exclude_patterns
+        self.version = version
+        self.unwatched = set()
+        self.file_stats = self.scan()
+        self.last_poll = time.monotonic()
+
+    # Stat every file in the backup folders
+    def scan(self):
+        file_stats = {}
+        for folder in self.backup_list:
+            folder_files, folder_stats, folder_bytes = scan_folder(folder, [], self.exclude_patterns, "", self.version)
+            file_stats.update(folder_stats)
+        return file_stats
+
+    # Wait up to timeout seconds, then report files added, changed or removed since the last poll
+    def read_changes(self, timeout):
+        remaining = watch_poll_interval - (time.monotonic() - self.last_poll)
+        if remaining > timeout:
+            time.sleep(timeout)
+            return [], False
+        time.sleep(max(remaining, 0))
+        file_stats = self.scan()
+        self.last_poll = time.monotonic()
+        changes = [path for path, signature in file_stats.items() if self.file_stats.get(path) != signature]
+        changes.extend(path for path in self.file_stats if path not in file_stats)
+        self.file_stats = file_stats
+        return changes, False
+
+    # Every folder is scanned, so there is nothing to retry
+    def retry_unwatched(self):
+        return False
+
+    # Stop watching
+    def close(self):
+        pass
+
+
+change_sources = {"inotify": InotifyChangeSource, "poll": PollChangeSource}
+
+
+# Get the change source to use - inotify on Linux, polling elsewhere
+def get_change_source(name):
+    if name == "auto":
+        name = "inotify" if sys.platform.startswith("linux") else "poll"
+    if name not in change_sources:
+        raise ValueError("Unknown change source: " + name)
+    return change_sources[name]
+
+
+# Dirty-set DB management
+def manage_dirty_db(config, action, version):
+    # Open/create DB - changed paths with the time they last changed, plus the watcher's state
+    if action == "open":
+        log("Opening dirty-set DB...", "Attempt", version)
+        config.dirty_db_name = config.computer_name + "_dirty.sqlite"
+        config.dirty_db_conn = sqlite3.connect(config.dirty_db_name, timeout=30)
+        config.dirty_db_cursor = config.dirty_db_conn.cursor()
+        config.dirty_db_cursor.execute("PRAGMA journal_mode=WAL;")
+        config.dirty_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_dirty(file TEXT PRIMARY KEY, time REAL);")
+        config.dirty_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_watch(key TEXT PRIMARY KEY, value TEXT);")
+        config.dirty_db_conn.commit()
+        log("Dirty-set DB opened successfully.", "Success", version)
+    # Close DB
+    if action == "close":
+        log("Closing dirty-set DB...", "Attempt", version)
+        config.dirty_db_conn.close()
+        log("Dirty-set DB closed successfully.", "Success", version)
+
+
+# Set watcher state values
+def set_watch_state(config, values):
+    config.dirty_db_cursor.executemany("INSERT OR REPLACE INTO backutil_watch (key, value) VALUES (?, ?);", values.items())
+    config.dirty_db_conn.commit()
+
+
+# Check the dirty set can stand in for a full scan - returns the reason a full scan is needed, or ""
+def check_dirty_set(config, watch_state):
+    if "started" not in watch_state:
+        return "watcher not running"
+    if time.time() - float(watch_state.get("heartbeat", 0)) > watch_heartbeat_interval * 3:
+        return "watcher not responding"
+    if watch_state.get("list_file", "") != os.path.abspath(config.backup_list_file):
+        return "watcher using a different backup list"
+    if "last_full_scan" not in watch_state or float(watch_state["started"]) > float(watch_state["last_full_scan"]):
+        return "no full scan since watcher started"
+    if time.time() - float(watch_state["last_full_scan"]) > config.full_scan_interval * 3600:
+        return "full scan interval reached"
+    if float(watch_state.get("rescan", 0)) > float(watch_state["last_full_scan"]):
+        return "changes need a full scan"
+    if int(watch_state.get("unwatched", 0)) > 0:
+        return "folders not watched"
+    return ""
+
+
+# Check whether a changed path is in a backup folder and not excluded, checking each folder above it as the full scan does
+def is_backed_up_path(path, backup_list, include_patterns, exclude_patterns):
+    for folder in backup_list:
+        if path.startswith(os.path.join(folder, "")):
+            break
+    else:
+        return False
+    current_path = folder
+    for name in path[len(os.path.join(folder, "")):].split(os.sep):
+        current_path = os.path.join(current_path, name)
+        if match_patterns(current_path, name, exclude_patterns):
+            return False
+    if include_patterns and not match_patterns(path, os.path.basename(path), include_patterns):
+        return False
+    return True
+
+
+# Get files to enumerate from the dirty set instead of scanning - returns None when a full scan is needed
+def get_dirty_files(config, backup_list, include_patterns, exclude_patterns, version):
+    start = time.perf_counter()
+    config.scan_time = time.time()
+    manage_dirty_db(config, "open", version)
+    watch_state = dict(config.dirty_db_cursor.execute("SELECT key, value FROM backutil_watch;").fetchall())
+    reason = check_dirty_set(config, watch_state)
+    if reason != "":
+        manage_dirty_db(config, "close", version)
+        log("Running a full scan (" + reason + ").", "Warning", version)
+        return None
+    query_data = (config.scan_time,)
+    config.dirty_rows = config.dirty_db_cursor.execute("SELECT file, time FROM backutil_dirty WHERE time <= ?;", query_data).fetchall()
+    config.dirty_files = [row[0] for row in config.dirty_rows]
+    manage_dirty_db(config, "close", version)
+
+    # Files whose only backup is about to expire are backed up again, as a full scan would
+    manage_previous_db(config, "open", version)
+    expire_prev_hashes(config, version)
+    latest_date = config.previous_db_cursor.execute("SELECT MAX(date) FROM backutil_catalog;").fetchone()[0]
+    if latest_date is None:
+        manage_previous_db(config, "close", version)
+        log("Running a full scan (no catalog of the last backup).", "Warning", version)
+        return None
+    query_data = (latest_date, config.hash_algorithm,)
+    expiring_files = [row[0] for row in config.previous_db_cursor.execute("SELECT file FROM backutil_catalog WHERE date = ? AND NOT EXISTS (SELECT 1 FROM backutil_previous AS previous WHERE previous.hash = backutil_catalog.hash AND previous.algorithm = ?);", query_data)]
+    manage_previous_db(config, "close", version)
+
+    backup_files = []
+    total_bytes = 0
+    for filename in sorted(set(config.dirty_files + expiring_files)):
+        if not is_backed_up_path(filename, backup_list, include_patterns, exclude_patterns):
+            continue
+        signature = get_stat_signature(filename)
+        if signature is None or not os.path.isfile(filename):
+            continue
+        backup_files.append(filename)
+        config.file_stats[filename] = signature
+        total_bytes += signature[0]
+    config.partial_scan = "True"
+    msg = "File list generated from dirty set (" + str(len(config.dirty_files)) + " changed paths, " + str(len(expiring_files)) + " expiring, " + str(len(backup_files)) + " files, " + str(total_bytes // 1048576) + " MB, " + ("%.2f" % (time.perf_counter() - start)) + " s)."
+    log(msg, "Success", version)
+    return backup_files
+
+
+# Reload the dirty paths a resumed partial backup started from - paths written after it started are left for the next backup
+def load_dirty_files(config, backup_files, version):
+    manage_dirty_db(config, "open", version)
+    query_data = (config.scan_time,)
+    backup_files = set(backup_files)
+    config.dirty_rows = [row for row in config.dirty_db_cursor.execute("SELECT file, time FROM backutil_dirty WHERE time <= ?;", query_data) if row[0] in backup_files or not os.path.exists(row[0])]
+    config.dirty_files = [row[0] for row in config.dirty_rows]
+    manage_dirty_db(config, "close", version)
+
+
+# Clear dirty paths covered by a completed backup, and record a completed full scan
+def finish_dirty_set(config, version):
+    manage_dirty_db(config, "open", version)
+
+    # A partial backup only covers the rows it read - a change flushed late, or changed again since, stays for the next one
+    if config.partial_scan == "True":
+        config.dirty_db_cursor.executemany("DELETE FROM backutil_dirty WHERE file = ? AND time = ?;", config.dirty_rows)
+    else:
+        query_data = (config.scan_time,)
+        config.dirty_db_cursor.execute("DELETE FROM backutil_dirty WHERE time <= ?;", query_data)
+        set_watch_state(config, {"last_full_scan": str(config.scan_time)})
+    config.dirty_db_conn.commit()
+    manage_dirty_db(config, "close", version)
+
+
+# Watch the backup folders, recording changed paths in the dirty set until interrupted
+def watch(config, source_name, version):
+    backup_list, include_patterns, exclude_patterns = read_backup_list(config.backup_list_file)
+    manage_dirty_db(config, "open", version)
+    config.dirty_db_cursor.execute("DELETE FROM backutil_watch WHERE key = 'started';")
+    config.dirty_db_conn.commit()
+    log("Starting " + source_name + " change source...", "Attempt", version)
+    source = get_change_source(source_name)(backup_list, exclude_patterns, version)
+
+    # Only changes after every folder is watched can be trusted, so the start time is set here
+    started = time.time()
+    set_watch_state(config, {"started": str(started), "heartbeat": str(started), "list_file": os.path.abspath(config.backup_list_file), "unwatched": str(len(source.unwatched))})
+    log("Watching " + str(len(backup_list)) + " backup folder(s) for changes.", "Success", version)
+    pending = {}
+    rescan = False
+    last_flush = time.monotonic()
+    last_heartbeat = time.monotonic()
+    try:
+        while True:
+            changes, source_rescan = source.read_changes(watch_flush_interval)
+            change_time = time.time()
+            for path in changes:
+                pending[path] = change_time
+            rescan = rescan or source_rescan
+
+            # Changes are written in batches, with a heartbeat so backups can tell the watcher is running
+            if time.monotonic() - last_flush >= watch_flush_interval:
+                config.dirty_db_cursor.executemany("INSERT OR REPLACE INTO backutil_dirty (file, time) VALUES (?, ?);", pending.items())
+                heartbeat = time.monotonic() - last_heartbeat >= watch_heartbeat_interval
+                if heartbeat:
+                    rescan = source.retry_unwatched() or rescan
+                values = {}
+                if rescan:
+                    values["rescan"] = str(time.time())
+                if heartbeat or values:
+                    values["heartbeat"] = str(time.time())
+                    values["unwatched"] = str(len(source.unwatched))
+                    last_heartbeat = time.monotonic()
+                set_watch_state(config, values)
+                if pending:
+                    log("Recorded " + str(len(pending)) + " changed path(s).", "Attempt", version)
+                pending = {}
+                rescan = False
+                last_flush = time.monotonic()
+
+            # The watcher can sit idle for hours, so its last log records are flushed rather than left buffered
+            flush_log()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+        config.dirty_db_cursor.executemany("INSERT OR REPLACE INTO backutil_dirty (file, time) VALUES (?, ?);", pending.items())
+        config.dirty_db_cursor.execute("DELETE FROM backutil_watch WHERE key = 'started';")
+        config.dirty_db_conn.commit()
+        manage_dirty_db(config, "close", version)
+        log("Stopped watching for changes.", "Success", version)
+
+
+# Main routine - runs the watcher for the configured backup list
+def main():
+    from backutil import version, Config
+    colorama.init()
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], "n:l:s:", ["name=", "list=", "source="])
+    except:
+        print_usage()
+        sys.exit()
+
+    # Backup name and list come from config.ini, as for backups
+    try:
+        config_file = configparser.ConfigParser()
+        config_file.read('config.ini')
+        config = Config(str(config_file['LOCAL']['computer_name']), str(config_file['LOCAL']['backup_list']), "", "", "", "False", 0, 0, "True", 1)
+        source_name = str(config_file['LOCAL'].get('watch_source', "auto"))
+    except:
+        log("Error loading configuration.", "Failure", version)
+        sys.exit()
+    for current_argument, current_value in arguments:
+        if current_argument in ("-n", "--name"):
+            config.computer_name = current_value
+        if current_argument in ("-l", "--list"):
+            config.backup_list_file = current_value
+        if current_argument in ("-s", "--source"):
+            source_name = current_value
+    watch(config, source_name, version)
+
+
+if __name__ == "__main__":
+    main()